@@ -0,0 +1,68 @@
+"""Move orders of ended events from ``orders`` into ``archived_orders``.
+
+Grabs, listings and exports only touch the hot ``orders`` table unless they
+ask for archived rows. Orders keep their ids when archived; ``orders`` never
+reuses an id (AUTOINCREMENT on SQLite), so they stay unique. Run from cron with
+``python -m backend.archive`` or trigger it via ``POST /admin/orders/archive``.
+"""
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session
+
+from . import jobs, models
+from .database import SessionLocal
+from .purge import delete_in_chunks
+
+# Days after an event's end_time before its orders are archived.
+ARCHIVE_AFTER_DAYS = int(os.getenv("ORDER_ARCHIVE_AFTER_DAYS", "30"))
+
+_ARCHIVED_COLUMNS = (
+    "id",
+    "user_id",
+    "event_id",
+    "ticket_type_id",
+    "created_at",
+    "price",
+)
+
+
+def _copy_to_archive(db: Session, order_ids: list[int]) -> None:
+    db.execute(
+        insert(models.ArchivedOrder).from_select(
+            list(_ARCHIVED_COLUMNS),
+            select(*(getattr(models.Order, name) for name in _ARCHIVED_COLUMNS)).where(
+                models.Order.id.in_(order_ids)
+            ),
+        )
+    )
+
+
+def archive_orders(job: jobs.Job, after_days: int = ARCHIVE_AFTER_DAYS) -> None:
+    cutoff = datetime.utcnow() - timedelta(days=after_days)
+    db = SessionLocal()
+    try:
+        ended_events = select(models.Event.id).where(
+            models.Event.end_time < cutoff,
+            models.Event.is_deleted.is_(False),
+        )
+        criteria = [models.Order.event_id.in_(ended_events)]
+        job.total = db.query(models.Order).filter(*criteria).count()
+        delete_in_chunks(
+            db, job, models.Order, *criteria, before_delete=_copy_to_archive
+        )
+    finally:
+        db.close()
+
+
+def order_models(include_archived: bool) -> tuple:
+    if include_archived:
+        return models.Order, models.ArchivedOrder
+    return (models.Order,)
+
+
+if __name__ == "__main__":
+    job = jobs.Job("archive_orders")
+    archive_orders(job)
+    print(f"archived {job.processed} orders")
@@ -0,0 +1,363 @@
+import csv
+import io
+import json
+import re
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Iterable, Iterator
+
+from sqlalchemy import bindparam
+from sqlalchemy.exc import SQLAlchemyError
+
+from . import auth, ledger, lottery, models, schemas, uploads
+from .database import SessionLocal
+
+BULK_CHUNK_SIZE = 500
+# bcrypt releases the GIL, so hashing a chunk in threads scales with cores.
+HASH_WORKERS = 8
+
+
+def decode_body(body: bytes) -> str:
+    """Decode an upload; raises ``UnicodeDecodeError`` unless it is UTF-8.
+
+    Call it before streaming a response so a bad upload can still get a 400.
+    """
+    return body.decode("utf-8-sig")
+
+
+def parse_rows(text: str, content_type: str | None) -> Iterator[tuple[int, dict | None, str | None]]:
+    """Yield ``(line, row, error)`` for a decoded CSV or JSON-lines upload."""
+    if content_type and "csv" in content_type:
+        reader = csv.DictReader(io.StringIO(text))
+        for row in reader:
+            yield reader.line_num, {k.strip(): v for k, v in row.items() if k}, None
+        return
+    for line_no, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield line_no, None, "无法解析的JSON行"
+            continue
+        if not isinstance(row, dict):
+            yield line_no, None, "每行必须是JSON对象"
+            continue
+        yield line_no, row, None
+
+
+def iter_chunks(rows: Iterable, size: int = BULK_CHUNK_SIZE) -> Iterator[list]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def ndjson(message: dict) -> str:
+    return json.dumps(message, ensure_ascii=False) + "\n"
+
+
+def _parse_int(value) -> int | None:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def provision_users(body: str, content_type: str | None) -> Iterator[str]:
+    """Create users in chunked bulk inserts, streaming NDJSON progress."""
+    processed = created = failed = 0
+    seen: set[str] = set()
+    db = SessionLocal()
+    try:
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS) as pool:
+            for chunk in iter_chunks(parse_rows(body, content_type)):
+                valid: list[tuple[int, str, str, int]] = []
+                for line_no, row, error in chunk:
+                    username = str((row or {}).get("username") or "").strip()
+                    password = str((row or {}).get("password") or "")
+                    coins = _parse_int((row or {}).get("energy_coins") or 0)
+                    if error is None:
+                        if not re.fullmatch(r"[A-Za-z0-9]+", username):
+                            error = "用户名只能包含字母和数字"
+                        elif not password:
+                            error = "密码不能为空"
+                        elif coins is None or coins < 0:
+                            error = "能量币必须为非负整数"
+                        elif username in seen:
+                            error = "用户名重复"
+                    if error is not None:
+                        failed += 1
+                        yield ndjson({"type": "error", "line": line_no, "username": username, "detail": error})
+                        continue
+                    seen.add(username)
+                    valid.append((line_no, username, password, coins))
+
+                existing = {
+                    row[0]
+                    for row in db.query(models.User.username).filter(
+                        models.User.username.in_([v[1] for v in valid])
+                    )
+                }
+                to_create = []
+                for entry in valid:
+                    if entry[1] in existing:
+                        failed += 1
+                        yield ndjson({"type": "error", "line": entry[0], "username": entry[1], "detail": "用户名已被注册"})
+                    else:
+                        to_create.append(entry)
+
+                hashes = list(pool.map(auth.get_password_hash, [e[2] for e in to_create]))
+                try:
+                    db.bulk_insert_mappings(
+                        models.User,
+                        [
+                            {
+                                "username": username,
+                                "hashed_password": hashed,
+                                "energy_coins": coins,
+                                "is_deleted": False,
+                            }
+                            for (_, username, _, coins), hashed in zip(to_create, hashes)
+                        ],
+                    )
+                    opening = {username: coins for _, username, _, coins in to_create if coins}
+                    if opening:
+                        ledger.append_entries(
+                            db,
+                            [
+                                {"user_id": user_id, "amount": opening[username], "reason": ledger.REASON_OPENING}
+                                for user_id, username in db.query(
+                                    models.User.id, models.User.username
+                                ).filter(models.User.username.in_(opening))
+                            ],
+                        )
+                    db.commit()
+                    created += len(to_create)
+                except SQLAlchemyError:
+                    db.rollback()
+                    failed += len(to_create)
+                    for line_no, username, _, _ in to_create:
+                        yield ndjson({"type": "error", "line": line_no, "username": username, "detail": "写入数据库失败"})
+                processed += len(chunk)
+                yield ndjson({"type": "progress", "processed": processed, "created": created, "failed": failed})
+    finally:
+        db.close()
+    yield ndjson({"type": "summary", "processed": processed, "created": created, "failed": failed})
+
+
+def update_coins(body: str, content_type: str | None, mode: str) -> Iterator[str]:
+    """Set or increment ``energy_coins`` for many users, streaming NDJSON progress.
+
+    Rows identify the user by ``user_id`` or ``username``; ``energy_coins`` is
+    the new balance in ``set`` mode and the delta in ``increment`` mode.
+    """
+    users_table = models.User.__table__
+    increment_stmt = (
+        users_table.update()
+        .where(users_table.c.id == bindparam("b_id"))
+        .values(energy_coins=users_table.c.energy_coins + bindparam("b_delta"))
+    )
+    processed = updated = failed = 0
+    db = SessionLocal()
+    try:
+        for chunk in iter_chunks(parse_rows(body, content_type)):
+            ids = {_parse_int((row or {}).get("user_id")) for _, row, _ in chunk} - {None}
+            names = {str(row.get("username")) for _, row, _ in chunk if row and row.get("username")}
+            balances: dict = {}
+            for user_id, username, coins in db.query(
+                models.User.id, models.User.username, models.User.energy_coins
+            ).filter(
+                (models.User.id.in_(ids) | models.User.username.in_(names)),
+                models.User.is_deleted.is_(False),
+            ):
+                balances[("id", user_id)] = (user_id, coins)
+                balances[("name", username)] = (user_id, coins)
+
+            changes: dict[int, int] = {}
+            for line_no, row, error in chunk:
+                row = row or {}
+                key = (
+                    ("id", _parse_int(row.get("user_id")))
+                    if row.get("user_id") not in (None, "")
+                    else ("name", str(row.get("username") or ""))
+                )
+                amount = _parse_int(row.get("energy_coins"))
+                match = balances.get(key)
+                if error is None:
+                    if match is None:
+                        error = "用户不存在"
+                    elif amount is None:
+                        error = "能量币必须为整数"
+                if error is None:
+                    user_id, balance = match
+                    current = balance + changes.get(user_id, 0)
+                    new_balance = amount if mode == "set" else current + amount
+                    if new_balance < 0:
+                        error = "能量币不能为负数"
+                    else:
+                        changes[user_id] = new_balance - balance
+                if error is not None:
+                    failed += 1
+                    yield ndjson({"type": "error", "line": line_no, "user": key[1], "detail": error})
+
+            try:
+                if changes:
+                    db.execute(
+                        increment_stmt,
+                        [{"b_id": user_id, "b_delta": delta} for user_id, delta in changes.items()],
+                    )
+                    reason = ledger.REASON_ADMIN_SET if mode == "set" else ledger.REASON_ADMIN_CREDIT
+                    ledger.append_entries(
+                        db,
+                        [
+                            {"user_id": user_id, "amount": delta, "reason": reason}
+                            for user_id, delta in changes.items()
+                            if delta
+                        ],
+                    )
+                db.commit()
+                updated += len(changes)
+            except SQLAlchemyError:
+                db.rollback()
+                failed += len(changes)
+                yield ndjson({"type": "error", "line": chunk[0][0], "detail": "写入数据库失败"})
+            processed += len(chunk)
+            yield ndjson({"type": "progress", "processed": processed, "updated": updated, "failed": failed})
+    finally:
+        db.close()
+    yield ndjson({"type": "summary", "processed": processed, "updated": updated, "failed": failed})
+
+
+def _normalize_import_row(row: dict) -> dict:
+    normalized = {key: (None if value == "" else value) for key, value in row.items()}
+    if isinstance(normalized.get("ticket_types"), str):
+        normalized["ticket_types"] = json.loads(normalized["ticket_types"])
+    return normalized
+
+
+def _resolve_image(
+    name: str | None,
+    archive: zipfile.ZipFile | None,
+    stored: dict[str, str],
+    dry_run: bool,
+) -> str | None:
+    if not name or name.startswith("/static/") or "://" in name:
+        return name
+    if archive is None:
+        raise KeyError(name)
+    archive.getinfo(name)
+    if dry_run:
+        return name
+    if name not in stored:
+        with archive.open(name) as source:
+            stored_name = uploads.store_stream(source, name)
+        uploads.schedule_variants(stored_name)
+        stored[name] = f"/static/{stored_name}"
+    return stored[name]
+
+
+def import_events(
+    body: str,
+    content_type: str | None,
+    images: BinaryIO | None = None,
+    dry_run: bool = False,
+) -> list[dict]:
+    """Validate a manifest up front, then insert events with their ticket types.
+
+    Each chunk of events and its ticket types commit together, so a failure
+    never leaves an event without its inventory. Raises ``zipfile.BadZipFile``
+    for an unreadable image archive.
+    """
+    results: list[dict] = []
+    valid: list[tuple[int, schemas.EventImport, str | None, str | None]] = []
+    archive = zipfile.ZipFile(images) if images is not None else None
+    stored: dict[str, str] = {}
+    try:
+        for line_no, row, error in parse_rows(body, content_type):
+            event = None
+            if error is None:
+                try:
+                    event = schemas.EventImport(**_normalize_import_row(row))
+                except (TypeError, ValueError) as exc:
+                    error = f"数据校验失败: {exc}"
+            if error is None:
+                error = lottery.validate_settings(
+                    event.allocation_mode, event.sale_start_time, event.lottery_draw_time
+                )
+            if error is None:
+                try:
+                    cover_image = _resolve_image(event.cover_image, archive, stored, dry_run)
+                    seat_map_url = _resolve_image(event.seat_map_url, archive, stored, dry_run)
+                except KeyError as exc:
+                    error = f"图片不存在: {exc.args[0]}"
+            if error is not None:
+                results.append({"line": line_no, "status": "error", "detail": error})
+                continue
+            valid.append((line_no, event, cover_image, seat_map_url))
+    finally:
+        if archive is not None:
+            archive.close()
+
+    if dry_run:
+        results.extend({"line": entry[0], "status": "valid"} for entry in valid)
+        return sorted(results, key=lambda result: result["line"])
+
+    db = SessionLocal()
+    try:
+        for chunk in iter_chunks(valid):
+            db_events = [
+                models.Event(
+                    title=event.title,
+                    organizer=event.organizer,
+                    location=event.location,
+                    description=event.description,
+                    sale_start_time=event.sale_start_time,
+                    start_time=event.start_time,
+                    end_time=event.end_time,
+                    cover_image=cover_image,
+                    seat_map_url=seat_map_url,
+                    limit_one_ticket_per_user=event.limit_one_ticket_per_user,
+                    allocation_mode=event.allocation_mode,
+                    lottery_draw_time=lottery.naive_utc(event.lottery_draw_time),
+                    lottery_seed=lottery.new_seed(),
+                    is_hot=event.is_hot,
+                    is_deleted=False,
+                )
+                for _, event, cover_image, seat_map_url in chunk
+            ]
+            try:
+                db.add_all(db_events)
+                db.flush()
+                db.bulk_insert_mappings(
+                    models.TicketType,
+                    [
+                        {
+                            "event_id": db_event.id,
+                            "price": tt.price,
+                            "seat_type": tt.seat_type,
+                            "available_qty": tt.available_qty,
+                        }
+                        for (_, event, _, _), db_event in zip(chunk, db_events)
+                        for tt in event.ticket_types
+                    ],
+                )
+                db.commit()
+            except SQLAlchemyError:
+                db.rollback()
+                results.extend(
+                    {"line": entry[0], "status": "error", "detail": "写入数据库失败"}
+                    for entry in chunk
+                )
+                continue
+            results.extend(
+                {"line": entry[0], "status": "created", "event_id": db_event.id}
+                for entry, db_event in zip(chunk, db_events)
+            )
+    finally:
+        db.close()
+    return sorted(results, key=lambda result: result["line"])
@@ -0,0 +1,97 @@
+"""Grab processing shared by the ticket queue, hot event workers and REST."""
+from datetime import datetime
+
+from sqlalchemy.orm import Session
+
+from . import ledger, lottery, models, sales
+
+SOLD_OUT = "座位已满"
+INSUFFICIENT_COINS = "能量币不足"
+# Failures the front end answers with the other ticket types still on sale.
+WITH_ALTERNATIVES = (SOLD_OUT, INSUFFICIENT_COINS)
+
+
+def fail(reason: str, **extra) -> dict:
+    return {"type": "grab_result", "status": "fail", "reason": reason, **extra}
+
+
+def grab(db: Session, event_id: int, ticket_type_id: int, user_id: int) -> dict:
+    """Try to buy one ticket and return the ``grab_result`` message.
+
+    Results stay small: a success carries the order id, ticket type and new
+    coin balance, and failures carry no alternatives; the WebSocket front
+    end adds those from its seat board. Lottery events record an entry
+    instead. Commits on success.
+    """
+    event = (
+        db.query(models.Event)
+        .filter(models.Event.id == event_id, models.Event.is_deleted.is_(False))
+        .first()
+    )
+    if not event:
+        return fail("活动不存在")
+    if datetime.utcnow() < event.sale_start_time:
+        return fail("抢票尚未开始")
+    if event.allocation_mode == lottery.MODE_LOTTERY:
+        entry, reason = lottery.enter(db, event, user_id, ticket_type_id)
+        if entry is None:
+            return fail(reason)
+        return {
+            "type": "grab_result",
+            "status": "entered",
+            "ticket_type_id": ticket_type_id,
+            "draw_time": event.lottery_draw_time.isoformat(),
+        }
+    if event.limit_one_ticket_per_user:
+        existing_order = (
+            db.query(models.Order)
+            .filter(
+                models.Order.event_id == event_id,
+                models.Order.user_id == user_id,
+            )
+            .first()
+        )
+        if existing_order:
+            return fail("已达到限购数量")
+    ticket_type = (
+        db.query(models.TicketType)
+        .filter(
+            models.TicketType.id == ticket_type_id,
+            models.TicketType.event_id == event_id,
+        )
+        .with_for_update()
+        .first()
+    )
+    if ticket_type is None:
+        return fail("票种不存在")
+    if ticket_type.available_qty <= 0:
+        return fail(SOLD_OUT)
+    order = models.Order(
+        user_id=user_id,
+        event_id=event_id,
+        ticket_type_id=ticket_type_id,
+        price=ticket_type.price,
+    )
+    db.add(order)
+    db.flush()
+    order_id = order.id
+    price = int(ticket_type.price)
+    balance = ledger.debit(db, user_id, price, ledger.REASON_GRAB, f"order:{order_id}")
+    if balance is None:
+        db.rollback()
+        user = (
+            db.query(models.User.id)
+            .filter(models.User.id == user_id, models.User.is_deleted.is_(False))
+            .first()
+        )
+        return fail(INSUFFICIENT_COINS if user else "用户不存在")
+    ticket_type.available_qty -= 1
+    sales.record_sale(db, event_id, ticket_type_id, ticket_type.price)
+    db.commit()
+    return {
+        "type": "grab_result",
+        "status": "success",
+        "order_id": order_id,
+        "ticket_type_id": ticket_type_id,
+        "energy_coins": balance,
+    }
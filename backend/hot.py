@@ -0,0 +1,195 @@
+"""Dedicated worker processes for events flagged ``is_hot``.
+
+With ``HOT_EVENT_WORKERS`` above zero the app starts that many processes and
+assigns every hot event to one of them by id. Each worker owns the grab
+ordering of its events: the front-end process forwards grabs over a
+``multiprocessing`` queue and relays the results and the fresh seat counts,
+so the grab transactions of several big on-sales run on separate cores
+instead of the front-end event loop. Meant for a single front-end process
+per node; every front-end process starts its own workers. A worker that
+exits is restarted on the next grab sent to it, and the grabs it still owed
+fail with ``WorkerExited``.
+"""
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+
+from . import grab, models, seats
+from .database import SessionLocal
+
+HOT_EVENT_WORKERS = int(os.getenv("HOT_EVENT_WORKERS", "0"))
+# How long an event's is_hot flag is cached by the front-end process.
+HOT_FLAG_TTL = 5.0
+# Grabs a worker has not started within this many seconds of being sent are
+# answered busy without running, so a long backlog cannot charge users late.
+HOT_REPLY_TIMEOUT = 30.0
+BUSY = "系统繁忙，请稍后重试"
+
+
+def _worker_main(requests, replies) -> None:
+    while True:
+        message = requests.get()
+        if message is None:
+            break
+        request_id, deadline, event_id, ticket_type_id, user_id = message
+        # CLOCK_MONOTONIC is shared by every process on the host.
+        if time.monotonic() > deadline:
+            replies.put((request_id, grab.fail(BUSY), None))
+            continue
+        rows = None
+        db = SessionLocal()
+        try:
+            try:
+                result = grab.grab(db, event_id, ticket_type_id, user_id)
+            except Exception:
+                db.rollback()
+                result = grab.fail(BUSY)
+            if result["status"] == "success":
+                rows = seats.load_rows(db, event_id)
+        finally:
+            db.close()
+        replies.put((request_id, result, rows))
+    replies.put(None)
+
+
+class WorkerExited(RuntimeError):
+    """The worker process exited before answering a grab."""
+
+
+def _resolve(future: Future, result=None, error: Exception | None = None) -> None:
+    # The caller may have given up on the future in the meantime.
+    try:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+class _Worker:
+    """One worker process, its queues and the grabs waiting on it."""
+
+    def __init__(self, context) -> None:
+        self.requests, self.replies = context.Queue(), context.Queue()
+        # request id -> future of the reply
+        self.pending: dict[int, Future] = {}
+        self.process = context.Process(
+            target=_worker_main, args=(self.requests, self.replies), daemon=True
+        )
+        self.process.start()
+
+
+class HotWorkers:
+    def __init__(self, count: int) -> None:
+        self.count = count
+        self._workers: list[_Worker] = []
+        self._context = multiprocessing.get_context("spawn")
+        self._ids = itertools.count()
+        self._flags: dict[int, tuple[bool, float]] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self._workers)
+
+    def start(self) -> None:
+        for _ in range(self.count):
+            self._workers.append(self._spawn())
+
+    def _spawn(self) -> _Worker:
+        worker = _Worker(self._context)
+        threading.Thread(target=self._relay, args=(worker,), daemon=True).start()
+        return worker
+
+    def _relay(self, worker: _Worker) -> None:
+        while True:
+            try:
+                message = worker.replies.get(timeout=1.0)
+            except queue.Empty:
+                self._prune(worker)
+                if not worker.process.is_alive():
+                    break
+                continue
+            if message is None:
+                break
+            request_id, result, rows = message
+            future = worker.pending.pop(request_id, None)
+            if future is not None:
+                _resolve(future, (result, rows))
+        for request_id in list(worker.pending):
+            future = worker.pending.pop(request_id, None)
+            if future is not None:
+                _resolve(future, error=WorkerExited("hot event worker exited"))
+
+    def _prune(self, worker: _Worker) -> None:
+        """Drop grabs whose callers have gone away, e.g. a closed socket."""
+        for request_id, future in list(worker.pending.items()):
+            if future.done():
+                worker.pending.pop(request_id, None)
+
+    def cached(self, event_id: int) -> bool | None:
+        """The cached ``owns`` answer, or ``None`` when it must be loaded."""
+        if not self._workers:
+            return False
+        flag = self._flags.get(event_id)
+        if flag is None or flag[1] < time.monotonic():
+            return None
+        return flag[0]
+
+    def owns(self, event_id: int) -> bool:
+        """Whether grabs for ``event_id`` go to a worker; cached briefly.
+
+        Queries the database on a cache miss, so call it off the event loop.
+        """
+        if not self._workers:
+            return False
+        flag = self._flags.get(event_id)
+        if flag is None or flag[1] < time.monotonic():
+            db = SessionLocal()
+            try:
+                hot = bool(
+                    db.query(models.Event.is_hot)
+                    .filter(models.Event.id == event_id)
+                    .scalar()
+                )
+            finally:
+                db.close()
+            flag = (hot, time.monotonic() + HOT_FLAG_TTL)
+            self._flags[event_id] = flag
+        return flag[0]
+
+    def forget(self, event_id: int) -> None:
+        self._flags.pop(event_id, None)
+
+    def submit(self, event_id: int, ticket_type_id: int, user_id: int) -> Future:
+        """Forward a grab; the future resolves to ``(result, seat rows or None)``.
+
+        Must be called from one thread, the event loop's. Every grab gets a
+        reply: the worker answers busy without running it once
+        ``HOT_REPLY_TIMEOUT`` has passed, so callers wait for the reply
+        rather than timing out while the grab could still commit.
+        """
+        index = event_id % len(self._workers)
+        worker = self._workers[index]
+        if not worker.process.is_alive():
+            worker = self._workers[index] = self._spawn()
+        request_id = next(self._ids)
+        future: Future = Future()
+        worker.pending[request_id] = future
+        deadline = time.monotonic() + HOT_REPLY_TIMEOUT
+        worker.requests.put((request_id, deadline, event_id, ticket_type_id, user_id))
+        return future
+
+    def stop(self) -> None:
+        for worker in self._workers:
+            worker.requests.put(None)
+        for worker in self._workers:
+            worker.process.join(timeout=5)
+        self._workers.clear()
+
+
+workers = HotWorkers(HOT_EVENT_WORKERS)
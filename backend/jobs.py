@@ -0,0 +1,137 @@
+import logging
+import threading
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from . import models
+from .database import SessionLocal
+
+# Finished jobs kept around for progress queries before the oldest are dropped.
+MAX_FINISHED_JOBS = 200
+# Seconds between progress writes of a running job.
+JOB_SAVE_INTERVAL = 1.0
+# A running job not written for this long lost its process (restart or crash).
+JOB_STALE_AFTER = 60
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    """Progress record of a background job; mutated by the worker thread."""
+
+    def __init__(self, kind: str, target_id: int | None = None) -> None:
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.target_id = target_id
+        self.status = "pending"
+        self.total = 0
+        self.processed = 0
+        self.errors: list[str] = []
+        self.created_at = datetime.utcnow()
+        self.finished_at: datetime | None = None
+
+
+def _save(job: Job) -> None:
+    db = SessionLocal()
+    try:
+        db.merge(
+            models.BackgroundJob(
+                id=job.id,
+                kind=job.kind,
+                target_id=job.target_id,
+                status=job.status,
+                total=job.total,
+                processed=job.processed,
+                errors=list(job.errors),
+                created_at=job.created_at,
+                finished_at=job.finished_at,
+                updated_at=datetime.utcnow(),
+            )
+        )
+        db.commit()
+    except Exception:
+        logger.exception("saving job %s failed", job.id)
+    finally:
+        db.close()
+
+
+def _prune_finished() -> None:
+    db = SessionLocal()
+    try:
+        record = models.BackgroundJob
+        keep = (
+            select(record.id)
+            .where(record.finished_at.isnot(None))
+            .order_by(record.finished_at.desc())
+            .limit(MAX_FINISHED_JOBS)
+        )
+        db.query(record).filter(
+            record.finished_at.isnot(None), record.id.notin_(keep)
+        ).delete(synchronize_session=False)
+        db.commit()
+    except Exception:
+        logger.exception("pruning finished jobs failed")
+    finally:
+        db.close()
+
+
+def _report(job: Job, finished: threading.Event) -> None:
+    while not finished.wait(JOB_SAVE_INTERVAL):
+        _save(job)
+
+
+def _run(job: Job, func: Callable[[Job], None]) -> None:
+    finished = threading.Event()
+    reporter = threading.Thread(target=_report, args=(job, finished), daemon=True)
+    job.status = "running"
+    reporter.start()
+    try:
+        func(job)
+        job.status = "done"
+    except Exception as exc:
+        job.status = "failed"
+        job.errors.append(str(exc))
+    finally:
+        job.finished_at = datetime.utcnow()
+        # Stop the reporter first so it cannot overwrite the final state.
+        finished.set()
+        reporter.join()
+        _save(job)
+        _prune_finished()
+
+
+def start_job(kind: str, func: Callable[[Job], None], target_id: int | None = None) -> Job:
+    """Run ``func(job)`` in a background thread and return its progress record."""
+    job = Job(kind, target_id)
+    _save(job)
+    threading.Thread(target=_run, args=(job, func), daemon=True).start()
+    return job
+
+
+def _mark_interrupted(db: Session) -> None:
+    record = models.BackgroundJob
+    now = datetime.utcnow()
+    db.query(record).filter(
+        record.status.in_(("pending", "running")),
+        record.updated_at < now - timedelta(seconds=JOB_STALE_AFTER),
+    ).update({"status": "interrupted", "finished_at": now}, synchronize_session=False)
+    db.commit()
+
+
+def list_jobs(db: Session) -> list[models.BackgroundJob]:
+    """Jobs started by any worker process, newest first."""
+    _mark_interrupted(db)
+    return (
+        db.query(models.BackgroundJob)
+        .order_by(models.BackgroundJob.created_at.desc())
+        .all()
+    )
+
+
+def get_job(db: Session, job_id: str) -> models.BackgroundJob | None:
+    _mark_interrupted(db)
+    return db.get(models.BackgroundJob, job_id)
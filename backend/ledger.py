@@ -0,0 +1,225 @@
+"""Energy coin ledger.
+
+Every coin change appends a ``CoinLedgerEntry`` in the same transaction that
+adjusts ``User.energy_coins``, which stays as the cached running balance so
+balance checks remain single-row reads. Debits are conditional atomic
+updates instead of row locks. ``compact`` folds old entries into one
+balance-forward entry per user; the app runs it every
+``LEDGER_COMPACT_INTERVAL_HOURS``, and overlapping runs from several
+processes skip the users another run already folded. ``verify``/``rebuild``
+compare the cached balances with the ledger:
+
+    python -m backend.ledger verify|rebuild|compact
+"""
+import os
+import sys
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from . import jobs, models
+from .database import SessionLocal
+
+REASON_OPENING = "opening"
+REASON_GRAB = "grab"
+REASON_LOTTERY = "lottery"
+REASON_ADMIN_SET = "admin_set"
+REASON_ADMIN_CREDIT = "admin_credit"
+REASON_USER_SET = "user_set"
+REASON_REFUND = "refund"
+REASON_BALANCE_FORWARD = "balance_forward"
+
+# Entries older than this many days are folded together by compaction.
+LEDGER_COMPACT_AFTER_DAYS = int(os.getenv("LEDGER_COMPACT_AFTER_DAYS", "30"))
+# How often each app process compacts the ledger; 0 leaves it to cron.
+LEDGER_COMPACT_INTERVAL_HOURS = float(os.getenv("LEDGER_COMPACT_INTERVAL_HOURS", "24"))
+COMPACT_CHUNK_SIZE = 500
+
+
+def _entry(user_id: int, amount: int, reason: str, ref: str | None = None) -> models.CoinLedgerEntry:
+    return models.CoinLedgerEntry(user_id=user_id, amount=amount, reason=reason, ref=ref)
+
+
+def debit(
+    db: Session, user_id: int, amount: int, reason: str, ref: str | None = None
+) -> int | None:
+    """Take ``amount`` coins if the balance covers it.
+
+    Returns the new balance, or ``None`` when the balance is too low or the
+    user is gone.
+    """
+    users = models.User.__table__
+    stmt = (
+        users.update()
+        .where(
+            users.c.id == user_id,
+            users.c.is_deleted.is_(False),
+            users.c.energy_coins >= amount,
+        )
+        .values(energy_coins=users.c.energy_coins - amount)
+    )
+    if db.get_bind().dialect.update_returning:
+        balance = db.execute(stmt.returning(users.c.energy_coins)).scalar()
+    elif db.execute(stmt).rowcount:
+        balance = (
+            db.query(models.User.energy_coins).filter(models.User.id == user_id).scalar()
+        )
+    else:
+        balance = None
+    if balance is None:
+        return None
+    db.add(_entry(user_id, -amount, reason, ref))
+    return balance
+
+
+def credit(
+    db: Session, user_id: int, amount: int, reason: str, ref: str | None = None
+) -> models.CoinLedgerEntry | None:
+    updated = (
+        db.query(models.User)
+        .filter(models.User.id == user_id)
+        .update(
+            {models.User.energy_coins: models.User.energy_coins + amount},
+            synchronize_session=False,
+        )
+    )
+    if not updated:
+        return None
+    entry = _entry(user_id, amount, reason, ref)
+    db.add(entry)
+    return entry
+
+
+def set_balance(db: Session, user_id: int, balance: int, reason: str) -> bool:
+    """Overwrite a balance, recording the difference; False if the user is gone."""
+    while True:
+        current = (
+            db.query(models.User.energy_coins).filter(models.User.id == user_id).scalar()
+        )
+        if current is None:
+            return False
+        # Compare-and-set so a concurrent debit is never overwritten unrecorded.
+        updated = (
+            db.query(models.User)
+            .filter(models.User.id == user_id, models.User.energy_coins == current)
+            .update({models.User.energy_coins: balance}, synchronize_session=False)
+        )
+        if updated:
+            if balance != current:
+                db.add(_entry(user_id, balance - current, reason))
+            return True
+
+
+def append_entries(db: Session, entries: list[dict]) -> None:
+    """Bulk-append entries whose balance changes were applied separately."""
+    if entries:
+        db.bulk_insert_mappings(
+            models.CoinLedgerEntry,
+            [{"created_at": datetime.utcnow(), "ref": None, **entry} for entry in entries],
+        )
+
+
+def verify(db: Session) -> list[tuple[int, int, int]]:
+    """Return ``(user_id, cached balance, ledger sum)`` for every mismatch."""
+    sums = (
+        db.query(
+            models.CoinLedgerEntry.user_id,
+            func.sum(models.CoinLedgerEntry.amount).label("total"),
+        )
+        .group_by(models.CoinLedgerEntry.user_id)
+        .subquery()
+    )
+    rows = db.query(
+        models.User.id,
+        models.User.energy_coins,
+        func.coalesce(sums.c.total, 0),
+    ).outerjoin(sums, sums.c.user_id == models.User.id)
+    return [
+        (user_id, cached or 0, total)
+        for user_id, cached, total in rows
+        if (cached or 0) != total
+    ]
+
+
+def rebuild(db: Session) -> int:
+    """Reset cached balances to the ledger sums; returns how many changed."""
+    mismatches = verify(db)
+    for user_id, _, total in mismatches:
+        db.query(models.User).filter(models.User.id == user_id).update(
+            {models.User.energy_coins: total}, synchronize_session=False
+        )
+    db.commit()
+    return len(mismatches)
+
+
+def compact(job: jobs.Job, after_days: int = LEDGER_COMPACT_AFTER_DAYS) -> None:
+    cutoff = datetime.utcnow() - timedelta(days=after_days)
+    old = models.CoinLedgerEntry.created_at < cutoff
+    db = SessionLocal()
+    try:
+        user_ids = [
+            row[0]
+            for row in db.query(models.CoinLedgerEntry.user_id)
+            .filter(old)
+            .group_by(models.CoinLedgerEntry.user_id)
+            .having(func.count() > 1)
+        ]
+        job.total = len(user_ids)
+        for start in range(0, len(user_ids), COMPACT_CHUNK_SIZE):
+            chunk = user_ids[start : start + COMPACT_CHUNK_SIZE]
+            in_chunk = models.CoinLedgerEntry.user_id.in_(chunk)
+            totals = db.query(
+                models.CoinLedgerEntry.user_id,
+                func.sum(models.CoinLedgerEntry.amount),
+                func.max(models.CoinLedgerEntry.created_at),
+                func.count(),
+                func.max(models.CoinLedgerEntry.id),
+            ).filter(old, in_chunk).group_by(models.CoinLedgerEntry.user_id).all()
+            summed = models.CoinLedgerEntry.id <= max((row[4] for row in totals), default=0)
+            deleted = db.query(models.CoinLedgerEntry).filter(old, in_chunk, summed).delete(
+                synchronize_session=False
+            )
+            if deleted != sum(row[3] for row in totals):
+                # Another run folded some of these users after they were summed.
+                db.rollback()
+                job.processed += len(chunk)
+                continue
+            db.bulk_insert_mappings(
+                models.CoinLedgerEntry,
+                [
+                    {
+                        "user_id": user_id,
+                        "amount": total,
+                        "reason": REASON_BALANCE_FORWARD,
+                        "ref": None,
+                        "created_at": last,
+                    }
+                    for user_id, total, last, _, _ in totals
+                ],
+            )
+            db.commit()
+            job.processed += len(chunk)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) == 2 else None
+    if command == "compact":
+        job = jobs.Job("compact_ledger")
+        compact(job)
+        print(f"compacted ledger entries of {job.processed} users")
+    elif command in ("verify", "rebuild"):
+        session = SessionLocal()
+        try:
+            if command == "verify":
+                mismatches = verify(session)
+                for user_id, cached, total in mismatches:
+                    print(f"user {user_id}: cached {cached}, ledger {total}")
+                sys.exit(1 if mismatches else 0)
+            print(f"rebuilt {rebuild(session)} balances from the ledger")
+        finally:
+            session.close()
+    else:
+        sys.exit("usage: python -m backend.ledger verify|rebuild|compact")
@@ -0,0 +1,263 @@
+"""Lottery allocation for oversubscribed events.
+
+Between ``sale_start_time`` and ``lottery_draw_time`` grabs on a lottery event
+only record a ``LotteryEntry``. The draw shuffles all entries with a
+``random.Random`` seeded from the event's ``lottery_seed`` and allocates the
+inventory in one pass and one transaction, so the same entries and seed
+always produce the same winners.
+"""
+import os
+import random
+import secrets
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+
+from sqlalchemy import bindparam
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from . import ledger, models, sales
+from .database import SessionLocal
+
+MODE_FCFS = "fcfs"
+MODE_LOTTERY = "lottery"
+ALLOCATION_MODES = (MODE_FCFS, MODE_LOTTERY)
+
+# How often each worker looks for lotteries that are due.
+LOTTERY_POLL_SECONDS = float(os.getenv("LOTTERY_POLL_SECONDS", "5"))
+
+
+def new_seed() -> str:
+    return secrets.token_hex(8)
+
+
+def naive_utc(value: datetime | None) -> datetime | None:
+    """Convert an aware time to naive UTC, the way times are stored."""
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def validate_settings(
+    mode: str, sale_start_time: datetime, draw_time: datetime | None
+) -> str | None:
+    """Return an error message for invalid allocation settings."""
+    if mode not in ALLOCATION_MODES:
+        return "分配方式无效"
+    draw_time = naive_utc(draw_time)
+    if mode == MODE_LOTTERY and (draw_time is None or draw_time <= naive_utc(sale_start_time)):
+        return "抽签模式需要设置晚于开售时间的开奖时间"
+    return None
+
+
+def enter(
+    db: Session, event: models.Event, user_id: int, ticket_type_id: int
+) -> tuple[models.LotteryEntry | None, str | None]:
+    """Record an entry; entering twice for one ticket type returns the first."""
+    if event.lottery_drawn_at is not None or datetime.utcnow() >= event.lottery_draw_time:
+        return None, "抽签登记已截止"
+    ticket_type = (
+        db.query(models.TicketType.id)
+        .filter(
+            models.TicketType.id == ticket_type_id,
+            models.TicketType.event_id == event.id,
+        )
+        .first()
+    )
+    if ticket_type is None:
+        return None, "票种不存在"
+    criteria = (
+        models.LotteryEntry.event_id == event.id,
+        models.LotteryEntry.user_id == user_id,
+        models.LotteryEntry.ticket_type_id == ticket_type_id,
+    )
+    entry = db.query(models.LotteryEntry).filter(*criteria).first()
+    if entry is not None:
+        return entry, None
+    entry = models.LotteryEntry(
+        event_id=event.id, user_id=user_id, ticket_type_id=ticket_type_id
+    )
+    db.add(entry)
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        return db.query(models.LotteryEntry).filter(*criteria).first(), None
+    return entry, None
+
+
+def due_event_ids(db: Session) -> list[int]:
+    return [
+        row[0]
+        for row in db.query(models.Event.id).filter(
+            models.Event.allocation_mode == MODE_LOTTERY,
+            models.Event.lottery_drawn_at.is_(None),
+            models.Event.lottery_draw_time <= datetime.utcnow(),
+            models.Event.is_deleted.is_(False),
+        )
+    ]
+
+
+def _allocate(
+    event: models.Event,
+    entries: list[tuple[int, int, int]],
+    stock: dict[int, list],
+    balances: dict[int, int],
+    holders: set[int],
+) -> tuple[list[int], dict[int, list[int]]]:
+    """Pick winning entries; mutates ``stock`` and ``balances``."""
+    shuffled = list(entries)
+    random.Random(f"{event.id}:{event.lottery_seed}").shuffle(shuffled)
+    won: list[int] = []
+    winners: dict[int, list[int]] = defaultdict(list)
+    for entry_id, user_id, ticket_type_id in shuffled:
+        ticket_type = stock.get(ticket_type_id)
+        if ticket_type is None or ticket_type[0] <= 0 or user_id not in balances:
+            continue
+        if event.limit_one_ticket_per_user and (user_id in winners or user_id in holders):
+            continue
+        price = int(ticket_type[1])
+        if balances[user_id] < price:
+            continue
+        balances[user_id] -= price
+        ticket_type[0] -= 1
+        won.append(entry_id)
+        winners[user_id].append(ticket_type_id)
+    return won, winners
+
+
+def draw(event_id: int) -> dict | None:
+    """Run the draw for one event; returns ``None`` if it is not due for one.
+
+    The event is claimed by setting ``lottery_drawn_at`` in the same
+    transaction that writes the results, so concurrent workers draw it once.
+    """
+    now = datetime.utcnow()
+    db = SessionLocal()
+    try:
+        claimed = (
+            db.query(models.Event)
+            .filter(
+                models.Event.id == event_id,
+                models.Event.allocation_mode == MODE_LOTTERY,
+                models.Event.lottery_drawn_at.is_(None),
+                models.Event.is_deleted.is_(False),
+            )
+            .update({models.Event.lottery_drawn_at: now}, synchronize_session=False)
+        )
+        if not claimed:
+            db.rollback()
+            return None
+        event = db.get(models.Event, event_id)
+        entries = [
+            tuple(row)
+            for row in db.query(
+                models.LotteryEntry.id,
+                models.LotteryEntry.user_id,
+                models.LotteryEntry.ticket_type_id,
+            )
+            .filter(
+                models.LotteryEntry.event_id == event_id,
+                models.LotteryEntry.status == "pending",
+            )
+            .order_by(models.LotteryEntry.id)
+        ]
+        stock = {
+            row.id: [row.available_qty, row.price]
+            for row in db.query(
+                models.TicketType.id,
+                models.TicketType.available_qty,
+                models.TicketType.price,
+            ).filter(models.TicketType.event_id == event_id)
+        }
+        entrants = {entry[1] for entry in entries}
+        balances = dict(
+            db.query(models.User.id, models.User.energy_coins).filter(
+                models.User.id.in_(entrants), models.User.is_deleted.is_(False)
+            )
+        )
+        holders = {
+            row[0]
+            for row in db.query(models.Order.user_id)
+            .filter(models.Order.event_id == event_id)
+            .distinct()
+        }
+        starting = dict(balances)
+        won, winners = _allocate(event, entries, stock, balances, holders)
+
+        if won:
+            entries_table = models.LotteryEntry.__table__
+            db.execute(
+                entries_table.update()
+                .where(entries_table.c.id == bindparam("b_id"))
+                .values(status="won"),
+                [{"b_id": entry_id} for entry_id in won],
+            )
+            users_table = models.User.__table__
+            db.execute(
+                users_table.update()
+                .where(users_table.c.id == bindparam("b_id"))
+                .values(energy_coins=users_table.c.energy_coins - bindparam("b_spent")),
+                [
+                    {"b_id": user_id, "b_spent": starting[user_id] - balances[user_id]}
+                    for user_id in winners
+                ],
+            )
+            ledger.append_entries(
+                db,
+                [
+                    {
+                        "user_id": user_id,
+                        "amount": balances[user_id] - starting[user_id],
+                        "reason": ledger.REASON_LOTTERY,
+                        "ref": f"event:{event_id}",
+                        "created_at": now,
+                    }
+                    for user_id in winners
+                ],
+            )
+            sold = Counter(
+                ticket_type_id
+                for ticket_type_ids in winners.values()
+                for ticket_type_id in ticket_type_ids
+            )
+            ticket_types_table = models.TicketType.__table__
+            db.execute(
+                ticket_types_table.update()
+                .where(ticket_types_table.c.id == bindparam("b_id"))
+                .values(available_qty=ticket_types_table.c.available_qty - bindparam("b_sold")),
+                [{"b_id": tt_id, "b_sold": count} for tt_id, count in sold.items()],
+            )
+            db.bulk_insert_mappings(
+                models.Order,
+                [
+                    {
+                        "user_id": user_id,
+                        "event_id": event_id,
+                        "ticket_type_id": ticket_type_id,
+                        "created_at": now,
+                        "price": stock[ticket_type_id][1],
+                    }
+                    for user_id, ticket_type_ids in winners.items()
+                    for ticket_type_id in ticket_type_ids
+                ],
+            )
+            for ticket_type_id, count in sold.items():
+                sales.record_sale(
+                    db, event_id, ticket_type_id, stock[ticket_type_id][1], now, count
+                )
+        db.query(models.LotteryEntry).filter(
+            models.LotteryEntry.event_id == event_id,
+            models.LotteryEntry.status == "pending",
+        ).update({models.LotteryEntry.status: "lost"}, synchronize_session=False)
+        db.commit()
+        return {
+            "event_id": event_id,
+            "seed": event.lottery_seed,
+            "entries": len(entries),
+            "winning_entries": len(won),
+            "winners": dict(winners),
+            "entrants": entrants,
+        }
+    finally:
+        db.close()
@@ -1,8 +1,12 @@
+import time
+
+_IMPORT_STARTED = time.perf_counter()
+
 from datetime import timedelta, datetime
 import asyncio
+import logging
 import os
 import uuid
-import shutil
 import json
 import io
 import zipfile
@@ -20,43 +24,41 @@ from fastapi import (
     UploadFile,
     File,
     Form,
-    Response,
+    Query,
+    Request,
 )
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import text
+from sqlalchemy import case
 from sqlalchemy.orm import Session, joinedload
-from fastapi.staticfiles import StaticFiles
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import StreamingResponse
+from starlette.responses import Response
+
+from . import (
+    archive,
+    auth,
+    bulk,
+    grab,
+    hot,
+    jobs,
+    ledger,
+    lottery,
+    migrations,
+    models,
+    purge,
+    recorder,
+    sales,
+    schedule,
+    schemas,
+    seats,
+    uploads,
+    wire,
+)
+from .database import engine, get_db, SessionLocal
+from .static_files import PrecompressedStaticFiles, precompress
 
-from . import auth, models, schemas
-from .database import Base, engine, get_db, SessionLocal
-
-Base.metadata.create_all(bind=engine)
-
-# Ensure newly added columns exist for older SQLite databases
-if engine.dialect.name == "sqlite":
-    with engine.begin() as conn:
-        event_columns = {
-            row[1] for row in conn.execute(text("PRAGMA table_info(events)"))
-        }
-        if "limit_one_ticket_per_user" not in event_columns:
-            conn.execute(
-                text(
-                    "ALTER TABLE events ADD COLUMN limit_one_ticket_per_user "
-                    "BOOLEAN DEFAULT 0"
-                )
-            )
-
-        user_columns = {
-            row[1] for row in conn.execute(text("PRAGMA table_info(users)"))
-        }
-        if "current_token_jti" not in user_columns:
-            conn.execute(
-                text(
-                    "ALTER TABLE users ADD COLUMN current_token_jti TEXT"
-                )
-            )
+logger = logging.getLogger(__name__)
 
 app = FastAPI(title="GrabTicket API")
 
@@ -76,19 +78,41 @@ app.add_middleware(
     allow_headers=["*"],
 )
 static_root = "static"
-app.mount("/static", StaticFiles(directory=static_root), name="static")
+app.mount("/static", PrecompressedStaticFiles(directory=static_root), name="static")
 
 assets_dir = os.path.join(static_root, "assets")
 if os.path.isdir(assets_dir):
-    app.mount("/assets", StaticFiles(directory=assets_dir), name="assets")
+    app.mount(
+        "/assets",
+        PrecompressedStaticFiles(directory=assets_dir, immutable=True),
+        name="assets",
+    )
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
+
+class Connection:
+    """State of one event WebSocket; ``binary`` marks the compact protocol."""
+
+    __slots__ = ("websocket", "user_id", "binary")
+
+    def __init__(self, websocket: WebSocket, user_id: int, binary: bool) -> None:
+        self.websocket = websocket
+        self.user_id = user_id
+        self.binary = binary
+
+
 # Store active WebSocket connections per event
-event_connections: Dict[int, Set[WebSocket]] = {}
+event_connections: Dict[int, Set[Connection]] = {}
 
-# Queue to ensure sequential ticket processing
-ticket_queue: asyncio.Queue = asyncio.Queue()
+# Queue to ensure sequential ticket processing. When it is full, "reject"
+# fails the new grab, "wait" makes the sender wait for room and
+# "drop_oldest" fails the longest-waiting grab to admit the new one.
+TICKET_QUEUE_MAXSIZE = int(os.getenv("TICKET_QUEUE_MAXSIZE", "10000"))
+TICKET_QUEUE_OVERFLOW = os.getenv("TICKET_QUEUE_OVERFLOW", "reject")
+ticket_queue: asyncio.Queue = asyncio.Queue(maxsize=TICKET_QUEUE_MAXSIZE)
+
+_BUSY_RESULT = {"type": "grab_result", "status": "fail", "reason": "系统繁忙，请稍后重试"}
 
 
 _CONTENT_TYPES_XML = (
@@ -189,7 +213,26 @@ def _build_sheet_xml(rows: list[list[str]]) -> str:
     )
 
 
-def _orders_to_rows(orders: list[models.Order]) -> list[list[str]]:
+def _list_orders(
+    db: Session, user_id: int | None = None, include_archived: bool = False
+) -> list:
+    """Orders newest first, optionally merged with the archived ones."""
+    orders: list = []
+    for model in archive.order_models(include_archived):
+        query = db.query(model).options(
+            joinedload(model.user),
+            joinedload(model.event),
+            joinedload(model.ticket_type),
+        )
+        if user_id is not None:
+            query = query.filter(model.user_id == user_id)
+        orders.extend(query.order_by(model.created_at.desc()))
+    if include_archived:
+        orders.sort(key=lambda order: order.created_at, reverse=True)
+    return orders
+
+
+def _orders_to_rows(orders: list) -> list[list[str]]:
     rows: list[list[str]] = [["订单ID", "用户名", "活动名称", "票档", "票价", "抢票时间"]]
     for order in orders:
         username = order.user.username if order.user else ""
@@ -214,7 +257,7 @@ def _orders_to_rows(orders: list[models.Order]) -> list[list[str]]:
     return rows
 
 
-def _build_orders_workbook(orders: list[models.Order]) -> io.BytesIO:
+def _build_orders_workbook(orders: list) -> io.BytesIO:
     buffer = io.BytesIO()
     sheet_xml = _build_sheet_xml(_orders_to_rows(orders))
     with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
@@ -233,22 +276,39 @@ def _ensure_admin(user: models.User) -> None:
         raise HTTPException(status_code=403, detail="只有管理员可以执行该操作")
 
 
+def _decode_upload(body: bytes) -> str:
+    try:
+        return bulk.decode_body(body)
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="文件必须使用UTF-8编码")
+
+
 @app.on_event("startup")
 async def startup_event() -> None:
-    """Launch background task processing the ticket queue and seed admin."""
+    """Check the schema version and launch the background tasks."""
+    app.state.schema_version = migrations.ensure_schema(engine)
     asyncio.create_task(_process_queue())
-    db = SessionLocal()
-    try:
-        if not db.query(models.User).filter(models.User.username == "admin").first():
-            admin_user = models.User(
-                username="admin",
-                hashed_password=auth.get_password_hash("admin"),
-                energy_coins=10000,
-            )
-            db.add(admin_user)
-            db.commit()
-    finally:
-        db.close()
+    asyncio.create_task(_lottery_scheduler())
+    asyncio.create_task(_seat_board_refresher())
+    if ledger.LEDGER_COMPACT_INTERVAL_HOURS > 0:
+        asyncio.create_task(_ledger_compactor())
+    asyncio.create_task(run_in_threadpool(precompress, static_root))
+    purge.resume_pending_purges()
+    if hot.HOT_EVENT_WORKERS > 0:
+        hot.workers.start()
+    app.state.startup_seconds = time.perf_counter() - _IMPORT_STARTED
+    logger.info(
+        "startup finished in %.1f ms (schema version %s)",
+        app.state.startup_seconds * 1000,
+        app.state.schema_version,
+    )
+
+
+@app.on_event("shutdown")
+async def shutdown_event() -> None:
+    uploads.shutdown_workers()
+    hot.workers.stop()
+    recorder.close()
 
 
 async def _process_queue() -> None:
@@ -256,154 +316,261 @@ async def _process_queue() -> None:
         request = await ticket_queue.get()
         try:
             await _handle_grab_request(request)
+        except Exception:
+            # One bad request or a closed socket must not stop the only worker.
+            logger.exception("grab request for event %s failed", request["event_id"])
+            reply = dict(_BUSY_RESULT)
+            if "request_id" in request:
+                reply["request_id"] = request["request_id"]
+            try:
+                await request["websocket"].send_json(reply)
+            except Exception:
+                pass
         finally:
             ticket_queue.task_done()
 
 
-async def _handle_grab_request(request: dict) -> None:
-    event_id = request["event_id"]
-    ticket_type_id = request["ticket_type_id"]
-    websocket: WebSocket = request["websocket"]
-    user_id = request["user_id"]
+async def _lottery_scheduler() -> None:
+    while True:
+        await asyncio.sleep(lottery.LOTTERY_POLL_SECONDS)
+        db = SessionLocal()
+        try:
+            event_ids = lottery.due_event_ids(db)
+        finally:
+            db.close()
+        for event_id in event_ids:
+            try:
+                await _run_lottery_draw(event_id)
+            except Exception:
+                logger.exception("lottery draw for event %s failed", event_id)
+
+
+async def _ledger_compactor() -> None:
+    while True:
+        await asyncio.sleep(ledger.LEDGER_COMPACT_INTERVAL_HOURS * 3600)
+        await run_in_threadpool(jobs.start_job, "compact_ledger", ledger.compact)
+
+
+def _load_board_rows(event_ids: list[int]) -> dict[int, list]:
     db = SessionLocal()
     try:
-        event = db.query(models.Event).filter(models.Event.id == event_id).first()
-        if not event:
-            await websocket.send_json(
-                {
-                    "type": "grab_result",
-                    "status": "fail",
-                    "reason": "活动不存在",
-                }
-            )
-            return
-        if datetime.utcnow() < event.sale_start_time:
-            await websocket.send_json(
+        return seats.load_live_rows(db, event_ids)
+    finally:
+        db.close()
+
+
+def _drop_seat_board(event_id: int) -> None:
+    board = seats.boards.pop(event_id, None)
+    if board is not None:
+        board.close()
+
+
+async def _seat_board_refresher() -> None:
+    """Reload every seat board, picking up changes made outside this process.
+
+    Boards without WebSocket connections that have gone idle are dropped
+    instead; the next reader loads them again.
+    """
+    while True:
+        await asyncio.sleep(seats.SEAT_BOARD_TTL / 2)
+        for event_id, board in list(seats.boards.items()):
+            if not event_connections.get(event_id) and board.idle():
+                _drop_seat_board(event_id)
+        event_ids = list(seats.boards)
+        if not event_ids:
+            continue
+        try:
+            rows = await run_in_threadpool(_load_board_rows, event_ids)
+            for event_id in event_ids:
+                if event_id in rows:
+                    await _publish_seat_rows(event_id, rows[event_id])
+                else:
+                    _drop_seat_board(event_id)
+        except Exception:
+            logger.exception("refreshing seat boards failed")
+
+
+async def _run_lottery_draw(event_id: int) -> dict | None:
+    result = await run_in_threadpool(lottery.draw, event_id)
+    if result is None:
+        return None
+    await _broadcast_seat_counts(event_id)
+    winners = result["winners"]
+    for conn in list(event_connections.get(event_id, set())):
+        if conn.user_id not in result["entrants"]:
+            continue
+        ticket_type_ids = winners.get(conn.user_id, [])
+        try:
+            await conn.websocket.send_json(
                 {
-                    "type": "grab_result",
-                    "status": "fail",
-                    "reason": "抢票尚未开始",
+                    "type": "lottery_result",
+                    "status": "won" if ticket_type_ids else "lost",
+                    "ticket_type_ids": ticket_type_ids,
                 }
             )
-            return
-        if event.limit_one_ticket_per_user:
-            existing_order = (
-                db.query(models.Order)
-                .filter(
-                    models.Order.event_id == event_id,
-                    models.Order.user_id == user_id,
-                )
-                .first()
-            )
-            if existing_order:
-                await websocket.send_json(
-                    {
-                        "type": "grab_result",
-                        "status": "fail",
-                        "reason": "已达到限购数量",
-                    }
-                )
-                return
-        ticket_type = (
-            db.query(models.TicketType)
-            .filter(
-                models.TicketType.id == ticket_type_id,
-                models.TicketType.event_id == event_id,
-            )
-            .with_for_update()
-            .first()
-        )
-        user = (
-            db.query(models.User)
-            .filter(models.User.id == user_id)
-            .with_for_update()
-            .first()
-        )
-        if (
-            ticket_type
-            and user
-            and ticket_type.available_qty > 0
-            and user.energy_coins >= int(ticket_type.price)
+        except Exception:
+            event_connections.get(event_id, set()).discard(conn)
+    return result
+
+
+async def _enqueue_grab(request: dict) -> bool:
+    """Queue a grab; returns False when it was shed because the queue is full."""
+    if TICKET_QUEUE_OVERFLOW == "wait":
+        await ticket_queue.put(request)
+        return True
+    if ticket_queue.full():
+        if TICKET_QUEUE_OVERFLOW != "drop_oldest":
+            return False
+        dropped = ticket_queue.get_nowait()
+        ticket_queue.task_done()
+        try:
+            await _reply_grab(dropped, _BUSY_RESULT)
+        except Exception:
+            pass
+    ticket_queue.put_nowait(request)
+    return True
+
+
+async def _reply_grab(request: dict, result: dict) -> None:
+    """Send a grab result.
+
+    Failures that list alternatives are answered with the seat board's cached
+    frame, so they cost neither a query nor a fresh serialization. A board
+    older than SEAT_BOARD_TTL is reloaded first so it cannot offer ticket
+    types that sold out elsewhere.
+    """
+    board = seats.boards.get(request["event_id"])
+    if board is not None and not board.fresh and result.get("reason") in grab.WITH_ALTERNATIVES:
+        await _broadcast_seat_counts(request["event_id"])
+        board = seats.boards.get(request["event_id"])
+    request_id = request.get("request_id")
+    if board is not None and result.get("reason") in grab.WITH_ALTERNATIVES:
+        frame = board.failure_frame(result["reason"], request["ticket_type_id"])
+        if request_id is not None:
+            # Splice the echo into the shared frame instead of re-encoding it.
+            frame = f'{frame[:-1]},"request_id":{json.dumps(request_id, ensure_ascii=False)}}}'
+        await request["websocket"].send_text(frame)
+    elif request_id is not None:
+        await request["websocket"].send_json({**result, "request_id": request_id})
+    else:
+        await request["websocket"].send_json(result)
+    outcome = recorder.outcome(result["status"], result.get("reason"))
+    recorder.record(
+        recorder.SOURCE_WS,
+        request["event_id"],
+        request["ticket_type_id"],
+        request["user_id"],
+        outcome,
+        request["received_at"],
+    )
+
+
+def _known_sold_out(event_id: int, ticket_type_id: int) -> bool:
+    # Only a fresh board is trusted, so a sell-out undone by an edit, a
+    # cancelled order or another process is seen within SEAT_BOARD_TTL.
+    board = seats.boards.get(event_id)
+    return board is not None and board.fresh and board.sold_out(ticket_type_id)
+
+
+async def _handle_grab_request(request: dict) -> None:
+    event_id = request["event_id"]
+    ticket_type_id = request["ticket_type_id"]
+    # Grabs queued before a sell-out are answered without a session.
+    if _known_sold_out(event_id, ticket_type_id):
+        await _reply_grab(request, grab.fail(grab.SOLD_OUT))
+        return
+    db = SessionLocal()
+    try:
+        result = grab.grab(db, event_id, ticket_type_id, request["user_id"])
+        if result.get("reason") == grab.SOLD_OUT and not _known_sold_out(
+            event_id, ticket_type_id
         ):
-            ticket_type.available_qty -= 1
-            user.energy_coins -= int(ticket_type.price)
-            order = models.Order(
-                user_id=user_id, event_id=event_id, ticket_type_id=ticket_type_id
-            )
-            db.add(order)
-            db.commit()
-            db.refresh(order)
-            await websocket.send_json(
-                {"type": "grab_result", "status": "success", "order_id": order.id}
-            )
-        else:
-            reason = "座位已满"
-            if not ticket_type or ticket_type.available_qty <= 0:
-                reason = "座位已满"
-            elif user is None:
-                reason = "用户不存在"
-            elif user.energy_coins < int(ticket_type.price):
-                reason = "能量币不足"
-            alternatives = (
-                db.query(models.TicketType)
-                .filter(
-                    models.TicketType.event_id == event_id,
-                    models.TicketType.available_qty > 0,
-                )
-                .all()
-            )
-            alt_list = [
-                {
-                    "ticket_type_id": t.id,
-                    "seat_type": t.seat_type,
-                    "available_qty": t.available_qty,
-                }
-                for t in alternatives
-                if t.id != ticket_type_id
-            ]
-            await websocket.send_json(
-                {
-                    "type": "grab_result",
-                    "status": "fail",
-                    "reason": reason,
-                    "alternatives": alt_list,
-                }
-            )
-        await _broadcast_seat_counts(event_id, db)
+            # The board missed a change; refresh it before listing alternatives.
+            await _broadcast_seat_counts(event_id, db)
+        await _reply_grab(request, result)
+        if result["status"] == "success":
+            await _broadcast_seat_counts(event_id, db)
     finally:
         db.close()
 
 
+async def _is_hot(event_id: int) -> bool:
+    owned = hot.workers.cached(event_id)
+    if owned is None:
+        owned = await run_in_threadpool(hot.workers.owns, event_id)
+    return owned
+
+
+async def _submit_hot_grab(
+    event_id: int, ticket_type_id: int, user_id: int
+) -> tuple[dict, list | None]:
+    """Grab through the event's worker process.
+
+    Waits for the worker's answer, which is busy for grabs it did not start
+    in time; a worker that exits fails its grabs as busy too.
+    """
+    future = hot.workers.submit(event_id, ticket_type_id, user_id)
+    try:
+        return await asyncio.wrap_future(future)
+    except hot.WorkerExited:
+        return _BUSY_RESULT, None
+
+
+async def _forward_hot_grab(request: dict) -> None:
+    result, rows = await _submit_hot_grab(
+        request["event_id"], request["ticket_type_id"], request["user_id"]
+    )
+    if result.get("reason") == grab.SOLD_OUT and not _known_sold_out(
+        request["event_id"], request["ticket_type_id"]
+    ):
+        await _broadcast_seat_counts(request["event_id"])
+    await _reply_grab(request, result)
+    if rows is not None:
+        await _publish_seat_rows(request["event_id"], rows)
+
+
 async def _broadcast_seat_counts(event_id: int, db: Session | None = None) -> None:
     close_db = False
     if db is None:
         db = SessionLocal()
         close_db = True
     try:
-        ticket_types = (
-            db.query(models.TicketType)
-            .filter(models.TicketType.event_id == event_id)
-            .all()
-        )
-        data = {
-            "type": "seat_counts",
-            "tickets": [
-                {
-                    "ticket_type_id": t.id,
-                    "seat_type": t.seat_type,
-                    "available_qty": t.available_qty,
-                }
-                for t in ticket_types
-            ],
-        }
-        for conn in list(event_connections.get(event_id, set())):
-            try:
-                await conn.send_json(data)
-            except Exception:
-                event_connections[event_id].discard(conn)
+        rows = seats.load_rows(db, event_id)
     finally:
         if close_db:
             db.close()
+    await _publish_seat_rows(event_id, rows)
+
+
+async def _publish_seat_rows(event_id: int, rows: list) -> None:
+    board, layout_changed, changed = seats.publish(event_id, rows)
+    if not layout_changed and not changed:
+        return
+    delta = None if layout_changed else board.delta_frame(changed)
+    for conn in list(event_connections.get(event_id, set())):
+        try:
+            if conn.binary and delta is not None:
+                await conn.websocket.send_bytes(delta)
+            else:
+                await _send_seat_snapshot(conn, board)
+        except Exception:
+            event_connections.get(event_id, set()).discard(conn)
+
+
+async def _send_seat_snapshot(conn: Connection, board: seats.SeatBoard) -> None:
+    if conn.binary:
+        await conn.websocket.send_text(board.meta_frame())
+        await conn.websocket.send_bytes(board.snapshot_frame())
+    else:
+        await conn.websocket.send_text(board.json_frame())
+
+
+def _get_live_event(db: Session, event_id: int) -> models.Event | None:
+    return (
+        db.query(models.Event)
+        .filter(models.Event.id == event_id, models.Event.is_deleted.is_(False))
+        .first()
+    )
 
 
 def _get_user_by_token(token: str, db: Session) -> models.User | None:
@@ -419,44 +586,138 @@ def _get_user_by_token(token: str, db: Session) -> models.User | None:
         .filter(models.User.username == token_data.username)
         .first()
     )
-    if user is None or user.current_token_jti != token_data.jti:
+    if (
+        user is None
+        or user.is_deleted
+        or user.current_token_jti != token_data.jti
+    ):
         return None
     return user
 
 
+def _authenticate_ws(token: str, event_id: int) -> tuple[int | None, list | None]:
+    """Return the user id and, when the event has no seat board yet, its rows.
+
+    The user id is ``None`` for a bad token or a missing or deleted event.
+    Runs in the threadpool and closes its session before returning, so an
+    open WebSocket holds no database connection.
+    """
+    db = SessionLocal()
+    try:
+        user = _get_user_by_token(token, db)
+        if user is None or _get_live_event(db, event_id) is None:
+            return None, None
+        rows = None if event_id in seats.boards else seats.load_rows(db, event_id)
+        return user.id, rows
+    finally:
+        db.close()
+
+
 @app.websocket("/ws/events/{event_id}")
 async def event_ws(websocket: WebSocket, event_id: int, token: str) -> None:
-    await websocket.accept()
-    db = SessionLocal()
-    user = _get_user_by_token(token, db)
-    if user is None:
+    binary = wire.SUBPROTOCOL in websocket.scope.get("subprotocols", [])
+    await websocket.accept(subprotocol=wire.SUBPROTOCOL if binary else None)
+    user_id, rows = await run_in_threadpool(_authenticate_ws, token, event_id)
+    if user_id is None:
+        await websocket.close(code=1008)
+        return
+    if rows is None and event_id not in seats.boards:
+        # The board went idle and was dropped while the user was authenticated.
+        rows = (await run_in_threadpool(_load_board_rows, [event_id])).get(event_id)
+    if rows is not None:
+        await _publish_seat_rows(event_id, rows)
+    board = seats.boards.get(event_id)
+    if board is None:
+        # The event was deleted while the user was being authenticated.
         await websocket.close(code=1008)
-        db.close()
         return
 
+    conn = Connection(websocket, user_id, binary)
     connections = event_connections.setdefault(event_id, set())
-    connections.add(websocket)
 
     try:
-        await _broadcast_seat_counts(event_id, db)
+        connections.add(conn)
+        await _send_seat_snapshot(conn, board)
         while True:
-            data = await websocket.receive_json()
-            if data.get("action") == "grab":
-                ticket_type_id = data.get("ticket_type_id")
-                if ticket_type_id is not None:
-                    await ticket_queue.put(
-                        {
-                            "websocket": websocket,
-                            "user_id": user.id,
-                            "event_id": event_id,
-                            "ticket_type_id": int(ticket_type_id),
-                        }
-                    )
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            if message.get("bytes") is not None:
+                request = wire.decode_request(message["bytes"])
+                if request is None:
+                    continue
+                op, ticket_type_id = request
+                request_id = None
+                if op == wire.OP_SYNC:
+                    await _send_seat_snapshot(conn, seats.boards.get(event_id, board))
+                    continue
+                if op != wire.OP_GRAB:
+                    continue
+            else:
+                try:
+                    data = json.loads(message.get("text") or "")
+                    if data.get("action") == "time_sync":
+                        await websocket.send_json(schedule.time_sync(data.get("client_time")))
+                        continue
+                    if data.get("action") != "grab":
+                        continue
+                    ticket_type_id = int(data["ticket_type_id"])
+                    request_id = data.get("request_id")
+                except (ValueError, TypeError, KeyError, AttributeError):
+                    continue
+            request = {
+                "websocket": websocket,
+                "user_id": user_id,
+                "event_id": event_id,
+                "ticket_type_id": ticket_type_id,
+                "received_at": time.time(),
+            }
+            if isinstance(request_id, int) or (
+                isinstance(request_id, str) and len(request_id) <= 64
+            ):
+                request["request_id"] = request_id
+            if not 0 < ticket_type_id < 2**63:
+                # Out of range for the database; no ticket type can match.
+                await _reply_grab(request, grab.fail("票种不存在"))
+                continue
+            start = schedule.cached(event_id)
+            if start is None:
+                start = await run_in_threadpool(schedule.sale_start, event_id)
+            early = schedule.early_failure(start)
+            if early is not None:
+                await _reply_grab(request, early)
+                continue
+            if _known_sold_out(event_id, ticket_type_id):
+                await _reply_grab(request, grab.fail(grab.SOLD_OUT))
+                continue
+            if await _is_hot(event_id):
+                await _forward_hot_grab(request)
+                continue
+            if not await _enqueue_grab(request):
+                await _reply_grab(request, _BUSY_RESULT)
     except WebSocketDisconnect:
         pass
     finally:
-        connections.remove(websocket)
-        db.close()
+        connections.discard(conn)
+        if not connections and event_connections.get(event_id) is connections:
+            del event_connections[event_id]
+
+
+@app.get("/time")
+async def server_time(response: Response, client_time: float | None = None):
+    """Clock probe: offset ≈ server_time - (client_time + receive time) / 2."""
+    response.headers["Cache-Control"] = "no-store"
+    return schedule.time_sync(client_time)
+
+
+@app.get("/health")
+def health():
+    return {
+        "status": "ok",
+        "schema_version": getattr(app.state, "schema_version", None),
+        "startup_seconds": getattr(app.state, "startup_seconds", None),
+        "websocket_connections": sum(map(len, event_connections.values())),
+    }
 
 
 # Dependency
@@ -471,7 +732,7 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="无效的令牌"
         )
     user = db.query(models.User).filter(models.User.username == token_data.username).first()
-    if user is None:
+    if user is None or user.is_deleted:
         raise HTTPException(status_code=400, detail="用户不存在")
     if user.current_token_jti != token_data.jti:
         raise HTTPException(
@@ -495,6 +756,15 @@ def register(user: schemas.UserCreate, db: Session = Depends(get_db)):
         energy_coins=user.energy_coins,
     )
     db.add(db_user)
+    db.flush()
+    if user.energy_coins:
+        db.add(
+            models.CoinLedgerEntry(
+                user_id=db_user.id,
+                amount=user.energy_coins,
+                reason=ledger.REASON_OPENING,
+            )
+        )
     db.commit()
     db.refresh(db_user)
     return db_user
@@ -503,7 +773,11 @@ def register(user: schemas.UserCreate, db: Session = Depends(get_db)):
 @app.post("/auth/login", response_model=schemas.Token)
 def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
     user = db.query(models.User).filter(models.User.username == form_data.username).first()
-    if not user or not auth.verify_password(form_data.password, user.hashed_password):
+    if (
+        not user
+        or user.is_deleted
+        or not auth.verify_password(form_data.password, user.hashed_password)
+    ):
         raise HTTPException(status_code=400, detail="用户名或密码错误")
     jti = str(uuid.uuid4())
     access_token = auth.create_access_token(
@@ -528,11 +802,12 @@ def update_current_user_coins(
 ):
     if data.energy_coins < 0:
         raise HTTPException(status_code=400, detail="能量币不能为负数")
-    user = db.query(models.User).filter(models.User.id == current_user.id).first()
-    if not user:
+    if not ledger.set_balance(
+        db, current_user.id, data.energy_coins, ledger.REASON_USER_SET
+    ):
         raise HTTPException(status_code=404, detail="用户不存在")
-    user.energy_coins = data.energy_coins
     db.commit()
+    user = db.get(models.User, current_user.id)
     db.refresh(user)
     return user
 
@@ -542,7 +817,7 @@ def admin_list_users(
     db: Session = Depends(get_db),
     current_user: models.User = Depends(get_current_user),
 ):
-    users = db.query(models.User).all()
+    users = db.query(models.User).filter(models.User.is_deleted.is_(False)).all()
     return users
 
 
@@ -553,15 +828,72 @@ def admin_update_coins(
     db: Session = Depends(get_db),
     current_user: models.User = Depends(get_current_user),
 ):
-    user = db.query(models.User).filter(models.User.id == user_id).first()
-    if not user:
+    if not ledger.set_balance(db, user_id, data.energy_coins, ledger.REASON_ADMIN_SET):
         raise HTTPException(status_code=404, detail="用户不存在")
-    user.energy_coins = data.energy_coins
     db.commit()
+    user = db.get(models.User, user_id)
     db.refresh(user)
     return user
 
 
+@app.get("/admin/users/{user_id}/coins/ledger", response_model=list[schemas.CoinLedgerEntry])
+def admin_coin_ledger(
+    user_id: int,
+    limit: int = 100,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+):
+    _ensure_admin(current_user)
+    if db.get(models.User, user_id) is None:
+        raise HTTPException(status_code=404, detail="用户不存在")
+    return (
+        db.query(models.CoinLedgerEntry)
+        .filter(models.CoinLedgerEntry.user_id == user_id)
+        .order_by(models.CoinLedgerEntry.id.desc())
+        .limit(max(1, min(limit, 1000)))
+        .all()
+    )
+
+
+@app.post(
+    "/admin/coins/compact",
+    response_model=schemas.Job,
+    status_code=status.HTTP_202_ACCEPTED,
+)
+def admin_compact_ledger(current_user: models.User = Depends(get_current_user)):
+    _ensure_admin(current_user)
+    return jobs.start_job("compact_ledger", ledger.compact)
+
+
+@app.post("/admin/users/bulk")
+async def admin_bulk_create_users(
+    request: Request,
+    current_user: models.User = Depends(get_current_user),
+):
+    """Create users from a CSV or JSON-lines body (username, password, energy_coins)."""
+    _ensure_admin(current_user)
+    body = _decode_upload(await request.body())
+    return StreamingResponse(
+        bulk.provision_users(body, request.headers.get("content-type")),
+        media_type="application/x-ndjson",
+    )
+
+
+@app.post("/admin/users/coins/bulk")
+async def admin_bulk_update_coins(
+    request: Request,
+    mode: str = Query("set", pattern="^(set|increment)$"),
+    current_user: models.User = Depends(get_current_user),
+):
+    """Set or increment energy coins from a CSV or JSON-lines body."""
+    _ensure_admin(current_user)
+    body = _decode_upload(await request.body())
+    return StreamingResponse(
+        bulk.update_coins(body, request.headers.get("content-type"), mode),
+        media_type="application/x-ndjson",
+    )
+
+
 @app.post("/admin/users/{user_id}/reset_password", response_model=schemas.User)
 def admin_reset_password(
     user_id: int,
@@ -577,61 +909,68 @@ def admin_reset_password(
     return user
 
 
-@app.delete("/admin/users/{user_id}", status_code=status.HTTP_204_NO_CONTENT)
+@app.delete(
+    "/admin/users/{user_id}",
+    response_model=schemas.Job,
+    status_code=status.HTTP_202_ACCEPTED,
+)
 def admin_delete_user(
     user_id: int,
     db: Session = Depends(get_db),
     current_user: models.User = Depends(get_current_user),
 ):
     user = db.query(models.User).filter(models.User.id == user_id).first()
-    if not user:
+    if not user or user.is_deleted:
         raise HTTPException(status_code=404, detail="用户不存在")
     if user.id == current_user.id:
         raise HTTPException(status_code=400, detail="无法删除当前登录用户")
     if user.username == "admin":
         raise HTTPException(status_code=400, detail="无法删除默认管理员账号")
-    db.query(models.Order).filter(models.Order.user_id == user_id).delete(
-        synchronize_session=False
-    )
-    db.delete(user)
+    user.is_deleted = True
+    user.current_token_jti = None
     db.commit()
+    return jobs.start_job("delete_user", purge.purge_user, user_id)
+
+
+@app.get("/admin/jobs", response_model=list[schemas.Job])
+def admin_list_jobs(
+    current_user: models.User = Depends(get_current_user), db: Session = Depends(get_db)
+):
+    _ensure_admin(current_user)
+    return jobs.list_jobs(db)
+
+
+@app.get("/admin/jobs/{job_id}", response_model=schemas.Job)
+def admin_read_job(
+    job_id: str,
+    current_user: models.User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    _ensure_admin(current_user)
+    job = jobs.get_job(db, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job
 
 
 @app.get("/admin/orders", response_model=list[schemas.Order])
 def admin_list_orders(
+    include_archived: bool = False,
     db: Session = Depends(get_db),
     current_user: models.User = Depends(get_current_user),
 ):
     _ensure_admin(current_user)
-    orders = (
-        db.query(models.Order)
-        .options(
-            joinedload(models.Order.user),
-            joinedload(models.Order.event),
-            joinedload(models.Order.ticket_type),
-        )
-        .order_by(models.Order.created_at.desc())
-        .all()
-    )
-    return orders
+    return _list_orders(db, include_archived=include_archived)
 
 
 @app.get("/admin/orders/export")
 def admin_export_orders(
+    include_archived: bool = False,
     db: Session = Depends(get_db),
     current_user: models.User = Depends(get_current_user),
 ):
     _ensure_admin(current_user)
-    orders = (
-        db.query(models.Order)
-        .options(
-            joinedload(models.Order.user),
-            joinedload(models.Order.event),
-            joinedload(models.Order.ticket_type),
-        )
-        .order_by(models.Order.created_at.desc())
-        .all()
-    )
+    orders = _list_orders(db, include_archived=include_archived)
     workbook = _build_orders_workbook(orders)
     filename = f"orders_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}.xlsx"
     headers = {
@@ -644,9 +983,51 @@ def admin_export_orders(
     )
 
 
+@app.post(
+    "/admin/orders/archive",
+    response_model=schemas.Job,
+    status_code=status.HTTP_202_ACCEPTED,
+)
+def admin_archive_orders(current_user: models.User = Depends(get_current_user)):
+    _ensure_admin(current_user)
+    return jobs.start_job("archive_orders", archive.archive_orders)
+
+
+@app.get("/admin/events/{event_id}/sales", response_model=schemas.EventSales)
+def admin_event_sales(
+    event_id: int,
+    minutes: int = Query(60, ge=1, le=24 * 60),
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+):
+    _ensure_admin(current_user)
+    counters = (
+        db.query(models.SalesCounter)
+        .filter(models.SalesCounter.event_id == event_id)
+        .all()
+    )
+    since = sales.bucket_start(datetime.utcnow() - timedelta(minutes=minutes - 1))
+    buckets = (
+        db.query(models.SalesBucket)
+        .filter(
+            models.SalesBucket.event_id == event_id,
+            models.SalesBucket.bucket_start >= since,
+        )
+        .order_by(models.SalesBucket.bucket_start)
+        .all()
+    )
+    return {
+        "event_id": event_id,
+        "sold_count": sum(c.sold_count for c in counters),
+        "revenue": sum(c.revenue for c in counters),
+        "ticket_types": counters,
+        "buckets": buckets,
+    }
+
+
 @app.get("/events", response_model=list[schemas.Event])
 def read_events(db: Session = Depends(get_db)):
-    events = db.query(models.Event).all()
+    events = db.query(models.Event).filter(models.Event.is_deleted.is_(False)).all()
     return events
 
 
@@ -660,6 +1041,9 @@ async def create_event(
     end_time: datetime | None = Form(None),
     description: str | None = Form(None),
     limit_one_ticket_per_user: bool = Form(False),
+    allocation_mode: str = Form(lottery.MODE_FCFS),
+    lottery_draw_time: datetime | None = Form(None),
+    is_hot: bool = Form(False),
     image: UploadFile | None = File(None),
     seat_map: UploadFile | None = File(None),
     ticket_types: str = Form("[]"),
@@ -668,24 +1052,16 @@ async def create_event(
 ):
     if current_user.username != "admin":
         raise HTTPException(status_code=403, detail="只有管理员可以创建活动")
+    lottery_draw_time = lottery.naive_utc(lottery_draw_time)
+    error = lottery.validate_settings(allocation_mode, sale_start_time, lottery_draw_time)
+    if error:
+        raise HTTPException(status_code=400, detail=error)
     image_path = None
     seat_map_path = None
     if image:
-        os.makedirs("static", exist_ok=True)
-        ext = os.path.splitext(image.filename)[1]
-        filename = f"{uuid.uuid4().hex}{ext}"
-        file_path = os.path.join("static", filename)
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(image.file, buffer)
-        image_path = f"/static/{filename}"
+        image_path = await uploads.save_upload(image)
     if seat_map:
-        os.makedirs("static", exist_ok=True)
-        ext = os.path.splitext(seat_map.filename)[1]
-        filename = f"{uuid.uuid4().hex}{ext}"
-        file_path = os.path.join("static", filename)
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(seat_map.file, buffer)
-        seat_map_path = f"/static/{filename}"
+        seat_map_path = await uploads.save_upload(seat_map)
 
     db_event = models.Event(
         title=title,
@@ -698,6 +1074,10 @@ async def create_event(
         cover_image=image_path,
         seat_map_url=seat_map_path,
         limit_one_ticket_per_user=limit_one_ticket_per_user,
+        allocation_mode=allocation_mode,
+        lottery_draw_time=lottery_draw_time,
+        lottery_seed=lottery.new_seed(),
+        is_hot=is_hot,
     )
     db.add(db_event)
     db.commit()
@@ -720,9 +1100,34 @@ async def create_event(
     return db_event
 
 
+@app.post("/admin/events/import", response_model=list[schemas.EventImportResult])
+async def admin_import_events(
+    manifest: UploadFile = File(...),
+    images: UploadFile | None = File(None),
+    dry_run: bool = Form(False),
+    current_user: models.User = Depends(get_current_user),
+):
+    """Import events from a JSON-lines or CSV manifest plus an optional image zip."""
+    _ensure_admin(current_user)
+    body = _decode_upload(await manifest.read())
+    content_type = manifest.content_type
+    if manifest.filename and manifest.filename.lower().endswith(".csv"):
+        content_type = "text/csv"
+    try:
+        return await run_in_threadpool(
+            bulk.import_events,
+            body,
+            content_type,
+            images.file if images else None,
+            dry_run,
+        )
+    except zipfile.BadZipFile:
+        raise HTTPException(status_code=400, detail="图片压缩包格式错误")
+
+
 @app.get("/events/{event_id}", response_model=schemas.Event)
 def read_event(event_id: int, db: Session = Depends(get_db)):
-    event = db.query(models.Event).filter(models.Event.id == event_id).first()
+    event = _get_live_event(db, event_id)
     if not event:
         raise HTTPException(status_code=404, detail="活动不存在")
     return event
@@ -739,6 +1144,9 @@ async def update_event(
     end_time: datetime | None = Form(None),
     description: str | None = Form(None),
     limit_one_ticket_per_user: bool = Form(False),
+    allocation_mode: str = Form(lottery.MODE_FCFS),
+    lottery_draw_time: datetime | None = Form(None),
+    is_hot: bool = Form(False),
     image: UploadFile | None = File(None),
     seat_map: UploadFile | None = File(None),
     ticket_types: str = Form("[]"),
@@ -747,25 +1155,26 @@ async def update_event(
 ):
     if current_user.username != "admin":
         raise HTTPException(status_code=403, detail="只有管理员可以更新活动")
-    event = db.query(models.Event).filter(models.Event.id == event_id).first()
+    event = _get_live_event(db, event_id)
     if not event:
         raise HTTPException(status_code=404, detail="活动不存在")
+    # The admin UI sends aware UTC times; compare them the way they are stored.
+    lottery_draw_time = lottery.naive_utc(lottery_draw_time)
+    error = lottery.validate_settings(allocation_mode, sale_start_time, lottery_draw_time)
+    if error:
+        raise HTTPException(status_code=400, detail=error)
+    if event.lottery_drawn_at is not None and (
+        allocation_mode != event.allocation_mode
+        or lottery_draw_time != event.lottery_draw_time
+    ):
+        raise HTTPException(status_code=400, detail="抽签已完成，无法修改分配方式")
+    replaced_files = set()
     if image:
-        os.makedirs("static", exist_ok=True)
-        ext = os.path.splitext(image.filename)[1]
-        filename = f"{uuid.uuid4().hex}{ext}"
-        file_path = os.path.join("static", filename)
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(image.file, buffer)
-        event.cover_image = f"/static/{filename}"
+        replaced_files.add(event.cover_image)
+        event.cover_image = await uploads.save_upload(image)
     if seat_map:
-        os.makedirs("static", exist_ok=True)
-        ext = os.path.splitext(seat_map.filename)[1]
-        filename = f"{uuid.uuid4().hex}{ext}"
-        file_path = os.path.join("static", filename)
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(seat_map.file, buffer)
-        event.seat_map_url = f"/static/{filename}"
+        replaced_files.add(event.seat_map_url)
+        event.seat_map_url = await uploads.save_upload(seat_map)
     event.title = title
     event.organizer = organizer
     event.location = location
@@ -774,25 +1183,113 @@ async def update_event(
     event.start_time = start_time
     event.end_time = end_time
     event.limit_one_ticket_per_user = limit_one_ticket_per_user
-    db.query(models.TicketType).filter(models.TicketType.event_id == event.id).delete()
+    event.allocation_mode = allocation_mode
+    event.lottery_draw_time = lottery_draw_time
+    if event.lottery_seed is None:
+        event.lottery_seed = lottery.new_seed()
+    event.is_hot = is_hot
+    hot.workers.forget(event.id)
+    schedule.forget(event.id)
     try:
         tts = json.loads(ticket_types)
     except Exception:
         tts = []
-    for t in tts:
-        tt = models.TicketType(
-            event_id=event.id,
-            price=t.get("price", 0),
-            seat_type=t.get("seat_type", ""),
-            available_qty=t.get("available_qty", 0),
-        )
-        db.add(tt)
+    seats_changed = _sync_ticket_types(db, event.id, tts)
     db.commit()
+    purge.remove_unreferenced_uploads(db, replaced_files)
+    if seats_changed:
+        await _broadcast_seat_counts(event.id, db)
     db.refresh(event)
     return event
 
 
-@app.delete("/events/{event_id}", status_code=status.HTTP_204_NO_CONTENT)
+def _sync_ticket_types(db: Session, event_id: int, tts: list[dict]) -> bool:
+    """Apply the submitted ticket types as a diff against the stored ones.
+
+    Entries carrying a known ``id`` are updated in place, entries without one
+    are inserted, and stored ticket types missing from the payload are deleted
+    unless orders or lottery entries reference them, in which case they are
+    closed for sale. An entry with ``original_qty`` (the count the editor
+    loaded) adjusts ``available_qty`` by the difference in one atomic update,
+    so seats sold while the form was open are not put back on sale.
+    Returns whether anything changed.
+    """
+    existing = {
+        tt.id: tt
+        for tt in db.query(models.TicketType).filter(
+            models.TicketType.event_id == event_id
+        )
+    }
+    changed = False
+    kept_ids: set[int] = set()
+    for t in tts:
+        try:
+            tt = existing.get(int(t.get("id")))
+        except (TypeError, ValueError):
+            tt = None
+        if tt is None:
+            db.add(
+                models.TicketType(
+                    event_id=event_id,
+                    price=t.get("price", 0),
+                    seat_type=t.get("seat_type", ""),
+                    available_qty=t.get("available_qty", 0),
+                )
+            )
+            changed = True
+            continue
+        kept_ids.add(tt.id)
+        for field in ("price", "seat_type"):
+            if field in t and getattr(tt, field) != t[field]:
+                setattr(tt, field, t[field])
+                changed = True
+        if "available_qty" not in t:
+            continue
+        try:
+            delta = int(t["available_qty"]) - int(t["original_qty"])
+        except (KeyError, TypeError, ValueError):
+            # No loaded count to compare with: the value is the new count.
+            if tt.available_qty != t["available_qty"]:
+                tt.available_qty = t["available_qty"]
+                changed = True
+            continue
+        if delta:
+            remaining = models.TicketType.available_qty + delta
+            db.query(models.TicketType).filter(models.TicketType.id == tt.id).update(
+                {
+                    models.TicketType.available_qty: case(
+                        (remaining < 0, 0), else_=remaining
+                    )
+                },
+                synchronize_session=False,
+            )
+            changed = True
+
+    removed_ids = set(existing) - kept_ids
+    if removed_ids:
+        ordered_ids = {
+            row[0]
+            for model in (*archive.order_models(include_archived=True), models.LotteryEntry)
+            for row in db.query(model.ticket_type_id)
+            .filter(model.ticket_type_id.in_(removed_ids))
+            .distinct()
+        }
+        for tt_id in removed_ids:
+            if tt_id in ordered_ids:
+                if existing[tt_id].available_qty != 0:
+                    existing[tt_id].available_qty = 0
+                    changed = True
+            else:
+                db.delete(existing[tt_id])
+                changed = True
+    return changed
+
+
+@app.delete(
+    "/events/{event_id}",
+    response_model=schemas.Job,
+    status_code=status.HTTP_202_ACCEPTED,
+)
 def delete_event(
     event_id: int,
     db: Session = Depends(get_db),
@@ -800,98 +1297,207 @@ def delete_event(
 ):
     if current_user.username != "admin":
         raise HTTPException(status_code=403, detail="只有管理员可以删除活动")
-    event = db.query(models.Event).filter(models.Event.id == event_id).first()
+    event = _get_live_event(db, event_id)
     if not event:
         raise HTTPException(status_code=404, detail="活动不存在")
 
-    def _remove_static_file(path: str | None) -> None:
-        if not path:
-            return
-        file_path = path.lstrip("/")
-        if os.path.exists(file_path) and os.path.isfile(file_path):
-            try:
-                os.remove(file_path)
-            except OSError:
-                pass
-
-    db.query(models.Order).filter(models.Order.event_id == event_id).delete(synchronize_session=False)
-    db.query(models.TicketType).filter(models.TicketType.event_id == event_id).delete(synchronize_session=False)
-    _remove_static_file(event.cover_image)
-    _remove_static_file(event.seat_map_url)
-    db.delete(event)
+    event.is_deleted = True
     db.commit()
     event_connections.pop(event_id, None)
-    return Response(status_code=status.HTTP_204_NO_CONTENT)
+    schedule.forget(event_id)
+    _drop_seat_board(event_id)
+    return jobs.start_job("delete_event", purge.purge_event, event_id)
+
 
+# Anonymous seat-count feeds for spectators: they read the shared SeatBoard
+# and only touch the database when an event's board is not loaded yet; the
+# refresher keeps loaded boards current.
+SEAT_POLL_MAX_WAIT = 30.0
+SEAT_STREAM_KEEPALIVE = 15.0
 
-@app.post("/events/{event_id}/tickets", response_model=schemas.Order)
-def grab_ticket(
+
+async def _get_seat_board(event_id: int) -> seats.SeatBoard:
+    board = seats.boards.get(event_id)
+    if board is None:
+        # Rows are read in the threadpool; the board is only touched on the loop.
+        rows = (await run_in_threadpool(_load_board_rows, [event_id])).get(event_id)
+        if rows is None:
+            raise HTTPException(status_code=404, detail="活动不存在")
+        await _publish_seat_rows(event_id, rows)
+        board = seats.boards[event_id]
+    board.touch()
+    return board
+
+
+@app.get("/events/{event_id}/seats")
+async def poll_seat_counts(
+    event_id: int,
+    since: int | None = None,
+    timeout: float = Query(25.0, ge=0, le=SEAT_POLL_MAX_WAIT),
+):
+    """Long-poll: answers at once unless ``since`` is the current sequence number."""
+    board = await _get_seat_board(event_id)
+    if since is not None:
+        await board.wait_for_change(since, timeout)
+    return Response(
+        board.json_frame(),
+        media_type="application/json",
+        headers={"ETag": f'"{board.seq}"', "Cache-Control": "public, max-age=1"},
+    )
+
+
+@app.get("/events/{event_id}/seats/stream")
+async def stream_seat_counts(event_id: int, request: Request):
+    board = await _get_seat_board(event_id)
+    try:
+        last_seq = int(request.headers.get("last-event-id", ""))
+    except ValueError:
+        last_seq = None
+
+    async def events():
+        seq = last_seq
+        # Counted as a reader for its whole life so the board is never evicted
+        # under it, which would reset seq for Last-Event-ID.
+        board.readers += 1
+        try:
+            while not board.closed:
+                if board.seq != seq:
+                    seq = board.seq
+                    yield board.sse_frame()
+                elif not await board.wait_for_change(seq, SEAT_STREAM_KEEPALIVE):
+                    if await request.is_disconnected():
+                        return
+                    yield ": keepalive\n\n"
+        finally:
+            board.readers -= 1
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.post("/events/{event_id}/tickets", response_model=schemas.GrabResult)
+async def grab_ticket(
     event_id: int,
     ticket_type_id: int,
     db: Session = Depends(get_db),
     current_user: models.User = Depends(get_current_user),
 ):
-    event = db.query(models.Event).filter(models.Event.id == event_id).first()
+    received_at = time.time()
+    outcome = "other"
+    try:
+        # Hot events are awaited here rather than blocking a threadpool thread.
+        if await run_in_threadpool(_check_grab, db, event_id, ticket_type_id):
+            result, rows = await _submit_hot_grab(event_id, ticket_type_id, current_user.id)
+        else:
+            result, rows = await run_in_threadpool(
+                _grab_ticket, db, event_id, ticket_type_id, current_user.id
+            )
+        if result["status"] != "success":
+            if result["reason"] in ("活动不存在", "票种不存在"):
+                status_code = 404
+            elif result["reason"] == _BUSY_RESULT["reason"]:
+                status_code = 503
+            else:
+                status_code = 400
+            raise HTTPException(status_code=status_code, detail=result["reason"])
+        outcome = "success"
+        await _publish_seat_rows(event_id, rows)
+        return result
+    except HTTPException as exc:
+        outcome = recorder.outcome("fail", exc.detail)
+        raise
+    finally:
+        recorder.record(
+            recorder.SOURCE_REST,
+            event_id,
+            ticket_type_id,
+            current_user.id,
+            outcome,
+            received_at,
+        )
+
+
+def _check_grab(db: Session, event_id: int, ticket_type_id: int) -> bool:
+    """Refuse REST grabs that cannot succeed; returns whether the event is hot."""
+    if schedule.not_started(event_id) is not None:
+        raise HTTPException(status_code=400, detail="抢票尚未开始")
+    if _known_sold_out(event_id, ticket_type_id):
+        raise HTTPException(status_code=400, detail=grab.SOLD_OUT)
+    event = _get_live_event(db, event_id)
     if not event:
         raise HTTPException(status_code=404, detail="活动不存在")
     if datetime.utcnow() < event.sale_start_time:
         raise HTTPException(status_code=400, detail="抢票尚未开始")
-    if event.limit_one_ticket_per_user:
-        existing_order = (
-            db.query(models.Order)
-            .filter(
-                models.Order.event_id == event_id,
-                models.Order.user_id == current_user.id,
-            )
-            .first()
-        )
-        if existing_order:
-            raise HTTPException(status_code=400, detail="已达到限购数量")
-    ticket_type = (
-        db.query(models.TicketType)
+    if event.allocation_mode == lottery.MODE_LOTTERY:
+        raise HTTPException(status_code=400, detail="该活动为抽签模式，请登记抽签")
+    return hot.workers.owns(event_id)
+
+
+def _grab_ticket(
+    db: Session, event_id: int, ticket_type_id: int, user_id: int
+) -> tuple[dict, list | None]:
+    """Grab in this process; returns the result and, on success, fresh seat rows."""
+    result = grab.grab(db, event_id, ticket_type_id, user_id)
+    rows = seats.load_rows(db, event_id) if result["status"] == "success" else None
+    return result, rows
+
+
+@app.post("/events/{event_id}/lottery/entries", response_model=schemas.LotteryEntry)
+def enter_lottery(
+    event_id: int,
+    ticket_type_id: int,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+):
+    event = _get_live_event(db, event_id)
+    if not event:
+        raise HTTPException(status_code=404, detail="活动不存在")
+    if event.allocation_mode != lottery.MODE_LOTTERY:
+        raise HTTPException(status_code=400, detail="该活动不是抽签模式")
+    if datetime.utcnow() < event.sale_start_time:
+        raise HTTPException(status_code=400, detail="抢票尚未开始")
+    entry, reason = lottery.enter(db, event, current_user.id, ticket_type_id)
+    if entry is None:
+        raise HTTPException(status_code=400, detail=reason)
+    return entry
+
+
+@app.get("/events/{event_id}/lottery/entries/me", response_model=list[schemas.LotteryEntry])
+def read_my_lottery_entries(
+    event_id: int,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+):
+    return (
+        db.query(models.LotteryEntry)
         .filter(
-            models.TicketType.id == ticket_type_id,
-            models.TicketType.event_id == event_id,
+            models.LotteryEntry.event_id == event_id,
+            models.LotteryEntry.user_id == current_user.id,
         )
-        .with_for_update()
-        .first()
-    )
-    if not ticket_type:
-        raise HTTPException(status_code=404, detail="票种不存在")
-    user = (
-        db.query(models.User)
-        .filter(models.User.id == current_user.id)
-        .with_for_update()
-        .first()
-    )
-    if ticket_type.available_qty <= 0:
-        raise HTTPException(status_code=400, detail="座位已满")
-    if user.energy_coins < int(ticket_type.price):
-        raise HTTPException(status_code=400, detail="能量币不足")
-    ticket_type.available_qty -= 1
-    user.energy_coins -= int(ticket_type.price)
-    order = models.Order(
-        user_id=current_user.id, event_id=event_id, ticket_type_id=ticket_type_id
+        .order_by(models.LotteryEntry.id)
+        .all()
     )
-    db.add(order)
-    db.commit()
-    db.refresh(order)
-    return order
+
+
+@app.post("/admin/events/{event_id}/lottery/draw", response_model=schemas.LotteryDraw)
+async def admin_draw_lottery(
+    event_id: int, current_user: models.User = Depends(get_current_user)
+):
+    """Draw now instead of waiting for ``lottery_draw_time``."""
+    _ensure_admin(current_user)
+    result = await _run_lottery_draw(event_id)
+    if result is None:
+        raise HTTPException(status_code=400, detail="该活动不是待开奖的抽签活动")
+    return result
 
 
 @app.get("/orders/me", response_model=list[schemas.Order])
 def read_my_orders(
+    include_archived: bool = False,
     db: Session = Depends(get_db),
     current_user: models.User = Depends(get_current_user),
 ):
-    orders = (
-        db.query(models.Order)
-        .options(
-            joinedload(models.Order.user),
-            joinedload(models.Order.event),
-            joinedload(models.Order.ticket_type),
-        )
-        .filter(models.Order.user_id == current_user.id)
-        .all()
-    )
-    return orders
+    return _list_orders(db, current_user.id, include_archived)
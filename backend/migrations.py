@@ -0,0 +1,257 @@
+"""Versioned schema migrations.
+
+Each applied migration is recorded as a row in ``schema_version``; worker
+startup only reads the highest applied version and migrates when it is behind
+``LATEST_VERSION``. Pending migrations run in one transaction that first takes
+a database-wide lock (``BEGIN IMMEDIATE`` on SQLite, an advisory lock on
+PostgreSQL) and re-reads the version, so workers starting together wait for
+the first one and then find nothing left to do. Run
+``python -m backend.migrations`` to migrate ahead of a deploy, or ``--check``
+to only report the version.
+"""
+import os
+import sys
+from datetime import datetime
+from typing import Callable
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    exists,
+    func,
+    inspect,
+    literal,
+    select,
+    text,
+)
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateTable
+
+from . import auth, models
+from .database import Base, engine
+
+AUTO_MIGRATE = os.getenv("AUTO_MIGRATE", "1") != "0"
+# Seconds a worker waits for another one's migrations to finish.
+MIGRATION_LOCK_TIMEOUT = 120
+# PostgreSQL advisory lock id shared by every worker.
+MIGRATION_LOCK_KEY = 0x47544D31
+
+_version_metadata = MetaData()
+schema_version = Table(
+    "schema_version",
+    _version_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("name", String),
+    Column("applied_at", DateTime, server_default=func.current_timestamp()),
+)
+
+
+def _add_column(conn: Connection, table: str, column: str, ddl: str) -> None:
+    columns = {c["name"] for c in inspect(conn).get_columns(table)}
+    if column not in columns:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+def _create_tables(conn: Connection) -> None:
+    Base.metadata.create_all(bind=conn)
+
+
+def _legacy_columns(conn: Connection) -> None:
+    _add_column(conn, "events", "limit_one_ticket_per_user", "BOOLEAN DEFAULT 0")
+    _add_column(conn, "users", "current_token_jti", "TEXT")
+
+
+def _soft_delete_flags(conn: Connection) -> None:
+    _add_column(conn, "events", "is_deleted", "BOOLEAN DEFAULT 0")
+    _add_column(conn, "users", "is_deleted", "BOOLEAN DEFAULT 0")
+
+
+def _archived_orders(conn: Connection) -> None:
+    models.ArchivedOrder.__table__.create(bind=conn, checkfirst=True)
+
+
+def _lottery(conn: Connection) -> None:
+    _add_column(conn, "events", "allocation_mode", "VARCHAR DEFAULT 'fcfs'")
+    _add_column(conn, "events", "lottery_draw_time", "DATETIME")
+    _add_column(conn, "events", "lottery_seed", "VARCHAR")
+    _add_column(conn, "events", "lottery_drawn_at", "DATETIME")
+    models.LotteryEntry.__table__.create(bind=conn, checkfirst=True)
+
+
+def _hot_events(conn: Connection) -> None:
+    _add_column(conn, "events", "is_hot", "BOOLEAN DEFAULT 0")
+
+
+def _coin_ledger(conn: Connection) -> None:
+    ledger = models.CoinLedgerEntry.__table__
+    users = models.User.__table__
+    ledger.create(bind=conn, checkfirst=True)
+    # Open the ledger of every existing user with their current balance.
+    conn.execute(
+        ledger.insert().from_select(
+            ["user_id", "amount", "reason", "created_at"],
+            select(
+                users.c.id,
+                func.coalesce(users.c.energy_coins, 0),
+                literal("opening"),
+                literal(datetime.utcnow()),
+            ).where(~exists().where(ledger.c.user_id == users.c.id)),
+        )
+    )
+
+
+def _seed_admin(conn: Connection) -> None:
+    users = models.User.__table__
+    if conn.execute(select(users.c.id).where(users.c.username == "admin")).first():
+        return
+    conn.execute(
+        users.insert().values(
+            username="admin",
+            hashed_password=auth.get_password_hash("admin"),
+            energy_coins=10000,
+            is_deleted=False,
+        )
+    )
+
+
+def _purge_claims(conn: Connection) -> None:
+    _add_column(conn, "events", "purge_started_at", "DATETIME")
+    _add_column(conn, "users", "purge_started_at", "DATETIME")
+
+
+def _order_autoincrement(conn: Connection) -> None:
+    # SQLite reuses the highest rowid once that row is gone, which let new
+    # orders collide with archived ones. AUTOINCREMENT needs a table rebuild.
+    if conn.dialect.name != "sqlite":
+        return
+    ddl = conn.execute(
+        text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'orders'")
+    ).scalar()
+    if ddl is None or "AUTOINCREMENT" in ddl.upper():
+        return
+    orders = models.Order.__table__
+    create = str(CreateTable(orders).compile(dialect=conn.dialect))
+    conn.execute(text(create.replace("TABLE orders", "TABLE orders_rebuilt", 1)))
+    existing = {c["name"] for c in inspect(conn).get_columns("orders")}
+    columns = ", ".join(c.name for c in orders.columns if c.name in existing)
+    conn.execute(
+        text(f"INSERT INTO orders_rebuilt ({columns}) SELECT {columns} FROM orders")
+    )
+    conn.execute(text("DROP TABLE orders"))
+    conn.execute(text("ALTER TABLE orders_rebuilt RENAME TO orders"))
+    for index in orders.indexes:
+        index.create(bind=conn, checkfirst=True)
+    # Continue after every id handed out so far, archived ones included.
+    conn.execute(text("DELETE FROM sqlite_sequence WHERE name = 'orders'"))
+    conn.execute(
+        text(
+            "INSERT INTO sqlite_sequence (name, seq) SELECT 'orders', max("
+            "coalesce((SELECT max(id) FROM orders), 0), "
+            "coalesce((SELECT max(id) FROM archived_orders), 0))"
+        )
+    )
+
+
+def _order_prices(conn: Connection) -> None:
+    # Backfill with the current price, the best record older orders have.
+    ticket_types = models.TicketType.__table__
+    for table in ("orders", "archived_orders"):
+        _add_column(conn, table, "price", "FLOAT")
+        orders = Table(table, MetaData(), autoload_with=conn)
+        conn.execute(
+            orders.update()
+            .where(orders.c.price.is_(None))
+            .values(
+                price=select(ticket_types.c.price)
+                .where(ticket_types.c.id == orders.c.ticket_type_id)
+                .scalar_subquery()
+            )
+        )
+
+
+def _jobs(conn: Connection) -> None:
+    models.BackgroundJob.__table__.create(bind=conn, checkfirst=True)
+
+
+MIGRATIONS: list[tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "create tables", _create_tables),
+    (2, "legacy columns", _legacy_columns),
+    (3, "soft delete flags", _soft_delete_flags),
+    (4, "seed admin", _seed_admin),
+    (5, "archived orders", _archived_orders),
+    (6, "lottery allocation", _lottery),
+    (7, "hot events", _hot_events),
+    (8, "coin ledger", _coin_ledger),
+    (9, "purge claims", _purge_claims),
+    (10, "order id autoincrement", _order_autoincrement),
+    (11, "order prices", _order_prices),
+    (12, "jobs", _jobs),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def _version(conn: Connection) -> int:
+    if not inspect(conn).has_table(schema_version.name):
+        return 0
+    return conn.execute(select(func.max(schema_version.c.version))).scalar() or 0
+
+
+def current_version(bind: Engine = engine) -> int:
+    with bind.connect() as conn:
+        return _version(conn)
+
+
+def _lock(conn: Connection) -> None:
+    """Hold the migration lock until the current transaction ends."""
+    if conn.dialect.name == "sqlite":
+        conn.exec_driver_sql(f"PRAGMA busy_timeout = {MIGRATION_LOCK_TIMEOUT * 1000}")
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+    elif conn.dialect.name == "postgresql":
+        conn.execute(
+            text(f"SET LOCAL lock_timeout = '{MIGRATION_LOCK_TIMEOUT}s'")
+        )
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+
+
+def migrate(bind: Engine = engine) -> int:
+    """Apply pending migrations in order and return the resulting version."""
+    try:
+        with bind.connect() as conn:
+            _lock(conn)
+            _version_metadata.create_all(bind=conn)
+            version = _version(conn)
+            for number, name, apply in MIGRATIONS:
+                if number > version:
+                    apply(conn)
+                    conn.execute(schema_version.insert().values(version=number, name=name))
+                    version = number
+            conn.commit()
+    except IntegrityError:
+        # Backends without a lock: another worker recorded the versions first.
+        version = current_version(bind)
+    return version
+
+
+def ensure_schema(bind: Engine = engine) -> int:
+    version = current_version(bind)
+    if version >= LATEST_VERSION:
+        return version
+    if not AUTO_MIGRATE:
+        raise RuntimeError(
+            f"database schema is at version {version}, expected {LATEST_VERSION}; "
+            "run `python -m backend.migrations`"
+        )
+    return migrate(bind)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--check"]:
+        version = current_version(engine)
+        print(f"schema version {version}, latest {LATEST_VERSION}")
+        sys.exit(0 if version >= LATEST_VERSION else 1)
+    print(f"schema version {migrate(engine)}")
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Float, Boolean
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Float, Boolean, JSON, UniqueConstraint
 from sqlalchemy.orm import relationship
 from datetime import datetime
 
@@ -13,6 +13,9 @@ class User(Base):
     hashed_password = Column(String)
     energy_coins = Column(Integer, default=0)
     current_token_jti = Column(String, nullable=True)
+    is_deleted = Column(Boolean, default=False)
+    # Set by the worker purging a deleted user, see backend.purge.
+    purge_started_at = Column(DateTime, nullable=True)
 
     orders = relationship("Order", back_populates="user")
 
@@ -31,6 +34,16 @@ class Event(Base):
     seat_map_url = Column(String, nullable=True)
     cover_image = Column(String, nullable=True)
     limit_one_ticket_per_user = Column(Boolean, default=False)
+    is_deleted = Column(Boolean, default=False)
+    purge_started_at = Column(DateTime, nullable=True)
+    # "fcfs" sells through the grab queue, "lottery" collects entries until
+    # lottery_draw_time and allocates everything in one draw.
+    allocation_mode = Column(String, default="fcfs")
+    lottery_draw_time = Column(DateTime, nullable=True)
+    lottery_seed = Column(String, nullable=True)
+    lottery_drawn_at = Column(DateTime, nullable=True)
+    # Grabs go to a dedicated worker process, see backend.hot.
+    is_hot = Column(Boolean, default=False)
 
     ticket_types = relationship("TicketType", back_populates="event")
     orders = relationship("Order", back_populates="event")
@@ -51,13 +64,99 @@ class TicketType(Base):
 
 class Order(Base):
     __tablename__ = "orders"
+    # Never reuse ids on SQLite; archived orders keep theirs in archived_orders.
+    __table_args__ = {"sqlite_autoincrement": True}
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     event_id = Column(Integer, ForeignKey("events.id"))
     ticket_type_id = Column(Integer, ForeignKey("ticket_types.id"))
     created_at = Column(DateTime, default=datetime.utcnow)
+    # Ticket price when sold; sales counters use it, not the current price.
+    price = Column(Float, nullable=True)
 
     user = relationship("User", back_populates="orders")
     event = relationship("Event", back_populates="orders")
     ticket_type = relationship("TicketType", back_populates="orders")
+
+
+class SalesCounter(Base):
+    __tablename__ = "sales_counters"
+
+    ticket_type_id = Column(Integer, ForeignKey("ticket_types.id"), primary_key=True)
+    event_id = Column(Integer, ForeignKey("events.id"), index=True)
+    sold_count = Column(Integer, default=0)
+    revenue = Column(Float, default=0)
+
+
+class SalesBucket(Base):
+    __tablename__ = "sales_buckets"
+
+    event_id = Column(Integer, ForeignKey("events.id"), primary_key=True)
+    bucket_start = Column(DateTime, primary_key=True)
+    ticket_type_id = Column(Integer, ForeignKey("ticket_types.id"), primary_key=True)
+    sold_count = Column(Integer, default=0)
+    revenue = Column(Float, default=0)
+
+
+class ArchivedOrder(Base):
+    """Orders of ended events, moved out of ``orders`` by ``backend.archive``."""
+
+    __tablename__ = "archived_orders"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    event_id = Column(Integer, ForeignKey("events.id"), index=True)
+    ticket_type_id = Column(Integer, ForeignKey("ticket_types.id"))
+    created_at = Column(DateTime)
+    price = Column(Float, nullable=True)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+
+    user = relationship("User")
+    event = relationship("Event")
+    ticket_type = relationship("TicketType")
+
+
+class LotteryEntry(Base):
+    __tablename__ = "lottery_entries"
+    __table_args__ = (UniqueConstraint("event_id", "user_id", "ticket_type_id"),)
+
+    id = Column(Integer, primary_key=True)
+    event_id = Column(Integer, ForeignKey("events.id"), index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    ticket_type_id = Column(Integer, ForeignKey("ticket_types.id"))
+    created_at = Column(DateTime, default=datetime.utcnow)
+    # pending until the draw, then won or lost
+    status = Column(String, default="pending")
+
+
+class CoinLedgerEntry(Base):
+    """One energy coin change; ``User.energy_coins`` caches the running sum."""
+
+    __tablename__ = "coin_ledger"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    amount = Column(Integer)
+    reason = Column(String)
+    # e.g. "order:12" or "event:3"
+    ref = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
+class BackgroundJob(Base):
+    """Saved progress of a ``jobs.Job`` so every worker process can report it."""
+
+    __tablename__ = "jobs"
+
+    id = Column(String, primary_key=True)
+    kind = Column(String)
+    target_id = Column(Integer, nullable=True)
+    status = Column(String)
+    total = Column(Integer, default=0)
+    processed = Column(Integer, default=0)
+    errors = Column(JSON, default=list)
+    created_at = Column(DateTime, index=True)
+    finished_at = Column(DateTime, nullable=True)
+    # Last write by the running process; stale running jobs were interrupted.
+    updated_at = Column(DateTime)
@@ -0,0 +1,211 @@
+import time
+from datetime import datetime, timedelta
+from functools import partial
+from typing import Callable
+
+from sqlalchemy.orm import Session
+
+from . import jobs, models, sales, uploads
+from .database import SessionLocal
+
+PURGE_CHUNK_SIZE = 500
+# Pause between chunks so queued grabs can take the write lock.
+PURGE_CHUNK_PAUSE = 0.01
+# A claim not renewed for this long belongs to a purge whose process died.
+PURGE_CLAIM_TIMEOUT = 300.0
+
+
+def remove_unreferenced_uploads(db: Session, urls: set[str | None]) -> None:
+    # Uploads are content-addressed, so several events may share one file.
+    for url in urls:
+        if not url:
+            continue
+        still_used = (
+            db.query(models.Event.id)
+            .filter(
+                (models.Event.cover_image == url)
+                | (models.Event.seat_map_url == url)
+            )
+            .first()
+        )
+        if still_used is None:
+            uploads.remove_upload(url)
+
+
+def delete_in_chunks(
+    db: Session,
+    job: jobs.Job,
+    model,
+    *criteria,
+    before_delete: Callable[[Session, list[int]], None] | None = None,
+    renew: Callable[[Session], None] | None = None,
+) -> None:
+    while True:
+        ids = [
+            row[0]
+            for row in db.query(model.id).filter(*criteria).limit(PURGE_CHUNK_SIZE)
+        ]
+        if not ids:
+            return
+        if before_delete is not None:
+            before_delete(db, ids)
+        db.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+        if renew is not None:
+            renew(db)
+        db.commit()
+        job.processed += len(ids)
+        time.sleep(PURGE_CHUNK_PAUSE)
+
+
+def _claim(db: Session, model, target_id: int) -> bool:
+    """Take the purge of a deleted row, like ``lottery.draw`` claims its event.
+
+    Every worker resumes pending purges at startup; only the one whose
+    conditional update matches does the work. Returns False otherwise.
+    """
+    now = datetime.utcnow()
+    claimed = (
+        db.query(model)
+        .filter(
+            model.id == target_id,
+            model.is_deleted.is_(True),
+            model.purge_started_at.is_(None)
+            | (model.purge_started_at < now - timedelta(seconds=PURGE_CLAIM_TIMEOUT)),
+        )
+        .update({model.purge_started_at: now}, synchronize_session=False)
+    )
+    db.commit()
+    return bool(claimed)
+
+
+def _renew_claim(db: Session, model, target_id: int) -> None:
+    db.query(model).filter(model.id == target_id).update(
+        {model.purge_started_at: datetime.utcnow()}, synchronize_session=False
+    )
+
+
+def purge_event(job: jobs.Job) -> None:
+    event_id = job.target_id
+    db = SessionLocal()
+    try:
+        if not _claim(db, models.Event, event_id):
+            return
+        renew = partial(_renew_claim, model=models.Event, target_id=event_id)
+        job.total = (
+            db.query(models.Order).filter(models.Order.event_id == event_id).count()
+            + db.query(models.ArchivedOrder)
+            .filter(models.ArchivedOrder.event_id == event_id)
+            .count()
+            + db.query(models.LotteryEntry)
+            .filter(models.LotteryEntry.event_id == event_id)
+            .count()
+            + db.query(models.TicketType)
+            .filter(models.TicketType.event_id == event_id)
+            .count()
+            + 1
+        )
+        delete_in_chunks(
+            db, job, models.Order, models.Order.event_id == event_id, renew=renew
+        )
+        delete_in_chunks(
+            db,
+            job,
+            models.ArchivedOrder,
+            models.ArchivedOrder.event_id == event_id,
+            renew=renew,
+        )
+        sales.delete_event_counters(db, event_id)
+        db.commit()
+        delete_in_chunks(
+            db,
+            job,
+            models.LotteryEntry,
+            models.LotteryEntry.event_id == event_id,
+            renew=renew,
+        )
+        delete_in_chunks(
+            db,
+            job,
+            models.TicketType,
+            models.TicketType.event_id == event_id,
+            renew=renew,
+        )
+        event = db.query(models.Event).filter(models.Event.id == event_id).first()
+        if event is not None:
+            static_files = {event.cover_image, event.seat_map_url}
+            db.delete(event)
+            db.commit()
+            remove_unreferenced_uploads(db, static_files)
+        job.processed += 1
+    finally:
+        db.close()
+
+
+def purge_user(job: jobs.Job) -> None:
+    user_id = job.target_id
+    db = SessionLocal()
+    try:
+        if not _claim(db, models.User, user_id):
+            return
+        renew = partial(_renew_claim, model=models.User, target_id=user_id)
+        job.total = (
+            db.query(models.Order).filter(models.Order.user_id == user_id).count()
+            + db.query(models.ArchivedOrder)
+            .filter(models.ArchivedOrder.user_id == user_id)
+            .count()
+            + 1
+        )
+        delete_in_chunks(
+            db,
+            job,
+            models.Order,
+            models.Order.user_id == user_id,
+            before_delete=sales.record_order_removals,
+            renew=renew,
+        )
+        delete_in_chunks(
+            db,
+            job,
+            models.ArchivedOrder,
+            models.ArchivedOrder.user_id == user_id,
+            before_delete=partial(
+                sales.record_order_removals, model=models.ArchivedOrder
+            ),
+            renew=renew,
+        )
+        db.query(models.LotteryEntry).filter(
+            models.LotteryEntry.user_id == user_id
+        ).delete(synchronize_session=False)
+        db.query(models.CoinLedgerEntry).filter(
+            models.CoinLedgerEntry.user_id == user_id
+        ).delete(synchronize_session=False)
+        db.query(models.User).filter(models.User.id == user_id).delete(
+            synchronize_session=False
+        )
+        db.commit()
+        job.processed += 1
+    finally:
+        db.close()
+
+
+def resume_pending_purges() -> None:
+    """Restart purges interrupted by a restart; rows stay marked deleted.
+
+    Runs in every worker; each purge is claimed, so only one worker runs it.
+    """
+    db = SessionLocal()
+    try:
+        event_ids = [
+            row[0]
+            for row in db.query(models.Event.id).filter(models.Event.is_deleted.is_(True))
+        ]
+        user_ids = [
+            row[0]
+            for row in db.query(models.User.id).filter(models.User.is_deleted.is_(True))
+        ]
+    finally:
+        db.close()
+    for event_id in event_ids:
+        jobs.start_job("delete_event", purge_event, event_id)
+    for user_id in user_ids:
+        jobs.start_job("delete_user", purge_user, user_id)
@@ -0,0 +1,155 @@
+"""Opt-in recording of grab traffic for ``backend.replay``.
+
+Set ``GRAB_RECORD_PATH`` to append one fixed-size record per grab: arrival
+time, source (WebSocket or REST), event, ticket type, a salted hash of the
+user id and the outcome. Users are anonymized with ``GRAB_RECORD_SALT``;
+without it every process picks a random salt, so set it when several workers
+write to the same file and the same user must map to the same hash.
+
+Event and ticket type ids that do not fit the record (negative or from
+2**32) are written as ``0``, which no row uses; such grabs always fail with
+``not_found`` and replay the same way.
+"""
+import hashlib
+import logging
+import os
+import struct
+import threading
+import time
+from typing import BinaryIO, Iterator, NamedTuple
+
+MAGIC = b"GTR1"
+
+SOURCE_WS = 1
+SOURCE_REST = 2
+
+OUTCOMES = (
+    "success",
+    "sold_out",
+    "not_started",
+    "limit_reached",
+    "insufficient_coins",
+    "busy",
+    "not_found",
+    "lottery_entered",
+    "other",
+)
+_REASONS = {
+    "座位已满": "sold_out",
+    "抢票尚未开始": "not_started",
+    "已达到限购数量": "limit_reached",
+    "能量币不足": "insufficient_coins",
+    "系统繁忙，请稍后重试": "busy",
+    "活动不存在": "not_found",
+    "票种不存在": "not_found",
+}
+
+# arrival time, source, event id, ticket type id, user hash, outcome index
+_RECORD = struct.Struct("<dBIIQB")
+_MAX_ID = 2**32 - 1
+
+logger = logging.getLogger(__name__)
+
+
+class Record(NamedTuple):
+    timestamp: float
+    source: int
+    event_id: int
+    ticket_type_id: int
+    user: int
+    outcome: str
+
+
+def _record_id(value: int) -> int:
+    return value if 0 <= value <= _MAX_ID else 0
+
+
+def outcome(status: str, reason: str | None = None) -> str:
+    if status == "success":
+        return "success"
+    if status == "entered":
+        return "lottery_entered"
+    return _REASONS.get(reason or "", "other")
+
+
+class Recorder:
+    def __init__(self, path: str, salt: bytes) -> None:
+        self._salt = salt
+        self._lock = threading.Lock()
+        self._file: BinaryIO = open(path, "ab")
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+
+    def anonymize(self, user_id: int) -> int:
+        digest = hashlib.blake2b(
+            str(user_id).encode(), key=self._salt, digest_size=8
+        ).digest()
+        return int.from_bytes(digest, "little")
+
+    def write(
+        self,
+        source: int,
+        event_id: int,
+        ticket_type_id: int,
+        user_id: int,
+        result: str,
+        received_at: float,
+    ) -> None:
+        data = _RECORD.pack(
+            received_at,
+            source,
+            _record_id(event_id),
+            _record_id(ticket_type_id),
+            self.anonymize(user_id),
+            OUTCOMES.index(result),
+        )
+        with self._lock:
+            self._file.write(data)
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+_recorder: Recorder | None = None
+if os.getenv("GRAB_RECORD_PATH"):
+    _recorder = Recorder(
+        os.environ["GRAB_RECORD_PATH"],
+        os.getenv("GRAB_RECORD_SALT", "").encode() or os.urandom(16),
+    )
+
+
+def record(
+    source: int,
+    event_id: int,
+    ticket_type_id: int,
+    user_id: int,
+    result: str,
+    received_at: float | None = None,
+) -> None:
+    """Record one grab; never raises, so recording cannot fail a grab."""
+    if _recorder is None:
+        return
+    try:
+        _recorder.write(
+            source, event_id, ticket_type_id, user_id, result, received_at or time.time()
+        )
+    except Exception:
+        logger.exception("recording grab for event %s failed", event_id)
+
+
+def close() -> None:
+    if _recorder is not None:
+        _recorder.close()
+
+
+def read_records(path: str) -> Iterator[Record]:
+    with open(path, "rb") as source:
+        if source.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a grab recording")
+        while True:
+            chunk = source.read(_RECORD.size)
+            if len(chunk) < _RECORD.size:
+                return
+            timestamp, kind, event_id, ticket_type_id, user, index = _RECORD.unpack(chunk)
+            yield Record(timestamp, kind, event_id, ticket_type_id, user, OUTCOMES[index])
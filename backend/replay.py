@@ -0,0 +1,362 @@
+"""Replay a grab recording made with ``GRAB_RECORD_PATH`` against an app.
+
+    python -m backend.replay grabs.rec --start --stock 100 --speed 2
+
+Grabs are sent at their recorded offsets divided by ``--speed``, over
+WebSocket or REST as recorded. Every anonymized user is provisioned as a
+``replay<hash>`` account through the bulk user endpoint. By default the
+recorded event and ticket type ids are used as they are, so point the app at
+a copy of the database taken before the sale; ``--stock`` instead creates a
+stand-in event per recorded event with that many seats per ticket type.
+The report lists latency percentiles and how outcomes differ from the
+recorded ones. Needs ``httpx`` and ``websockets``.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+from . import recorder
+
+PASSWORD = "replay"
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def start_server(port: int, database_url: str, *uvicorn_args: str) -> subprocess.Popen:
+    env = dict(os.environ, DATABASE_URL=database_url)
+    env.pop("GRAB_RECORD_PATH", None)
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "backend.main:app", "--port", str(port), *uvicorn_args],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+async def wait_healthy(client, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if (await client.get("/health")).status_code == 200:
+                return
+        except Exception:
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError("app did not become healthy")
+        await asyncio.sleep(0.2)
+
+
+async def login(client, username: str, password: str) -> str:
+    response = await client.post(
+        "/auth/login", data={"username": username, "password": password}
+    )
+    response.raise_for_status()
+    return response.json()["access_token"]
+
+
+async def provision_users(client, headers: dict, users: set[int], coins: int) -> dict[int, str]:
+    """Create one account per anonymized user and return their tokens."""
+    body = "\n".join(
+        json.dumps({"username": f"replay{user:x}", "password": PASSWORD, "energy_coins": coins})
+        for user in sorted(users)
+    )
+    response = await client.post(
+        "/admin/users/bulk",
+        content=body.encode(),
+        headers={**headers, "Content-Type": "application/x-ndjson"},
+        timeout=None,
+    )
+    response.raise_for_status()
+    limit = asyncio.Semaphore(8)
+
+    async def token_for(user: int) -> tuple[int, str]:
+        async with limit:
+            return user, await login(client, f"replay{user:x}", PASSWORD)
+
+    return dict(await asyncio.gather(*(token_for(user) for user in users)))
+
+
+async def create_events(
+    client, headers: dict, records: list[recorder.Record], stock: int
+) -> tuple[dict[int, int], dict[int, int]]:
+    """Create a stand-in event per recorded one; returns event and ticket type id maps."""
+    ticket_types: dict[int, set[int]] = defaultdict(set)
+    for record in records:
+        ticket_types[record.event_id].add(record.ticket_type_id)
+    sale_start = datetime.utcnow() - timedelta(minutes=1)
+    event_map: dict[int, int] = {}
+    ticket_type_map: dict[int, int] = {}
+    for event_id, recorded_ids in sorted(ticket_types.items()):
+        recorded_ids = sorted(recorded_ids)
+        response = await client.post(
+            "/events",
+            headers=headers,
+            data={
+                "title": f"replay {event_id}",
+                "organizer": "replay",
+                "location": "replay",
+                "sale_start_time": sale_start.isoformat(),
+                "start_time": (sale_start + timedelta(days=1)).isoformat(),
+                "ticket_types": json.dumps(
+                    [
+                        {"seat_type": str(tt_id), "price": 1, "available_qty": stock}
+                        for tt_id in recorded_ids
+                    ]
+                ),
+            },
+        )
+        response.raise_for_status()
+        event = response.json()
+        event_map[event_id] = event["id"]
+        created = {tt["seat_type"]: tt["id"] for tt in event["ticket_types"]}
+        for tt_id in recorded_ids:
+            ticket_type_map[tt_id] = created[str(tt_id)]
+    return event_map, ticket_type_map
+
+
+class Replayer:
+    def __init__(self, client, ws_url: str, tokens: dict[int, str], timeout: float) -> None:
+        self.client = client
+        self.ws_url = ws_url
+        self.tokens = tokens
+        self.timeout = timeout
+        self.connections: dict[tuple[int, int], object] = {}
+        # request id -> future of its grab_result; results can arrive out of order
+        self.pending: dict[int, asyncio.Future] = {}
+        self.request_ids = itertools.count(1)
+        self.readers: list[asyncio.Task] = []
+
+    async def connect(self, user: int, event_id: int) -> None:
+        import websockets
+
+        connection = await websockets.connect(
+            f"{self.ws_url}/ws/events/{event_id}?token={self.tokens[user]}",
+            max_size=None,
+        )
+        self.connections[(user, event_id)] = connection
+        self.readers.append(asyncio.create_task(self._read(connection)))
+
+    async def _read(self, connection) -> None:
+        async for message in connection:
+            if isinstance(message, bytes):
+                continue
+            data = json.loads(message)
+            if data.get("type") != "grab_result":
+                continue
+            future = self.pending.pop(data.get("request_id"), None)
+            if future is not None and not future.done():
+                future.set_result(data)
+
+    async def grab(self, source: int, user: int, event_id: int, ticket_type_id: int) -> tuple[float, str]:
+        started = time.perf_counter()
+        try:
+            if source == recorder.SOURCE_WS:
+                request_id = next(self.request_ids)
+                future = self.pending[request_id] = asyncio.get_running_loop().create_future()
+                try:
+                    await self.connections[(user, event_id)].send(
+                        json.dumps(
+                            {
+                                "action": "grab",
+                                "ticket_type_id": ticket_type_id,
+                                "request_id": request_id,
+                            }
+                        )
+                    )
+                    data = await asyncio.wait_for(future, self.timeout)
+                finally:
+                    self.pending.pop(request_id, None)
+                outcome = recorder.outcome(data["status"], data.get("reason"))
+            else:
+                response = await self.client.post(
+                    f"/events/{event_id}/tickets",
+                    params={"ticket_type_id": ticket_type_id},
+                    headers={"Authorization": f"Bearer {self.tokens[user]}"},
+                    timeout=self.timeout,
+                )
+                if response.status_code == 200:
+                    outcome = "success"
+                else:
+                    outcome = recorder.outcome("fail", response.json().get("detail"))
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+        except Exception:
+            outcome = "error"
+        return (time.perf_counter() - started) * 1000, outcome
+
+    async def close(self) -> None:
+        for connection in self.connections.values():
+            await connection.close()
+        for reader in self.readers:
+            reader.cancel()
+
+
+async def replay(args: argparse.Namespace) -> dict:
+    import httpx
+
+    records = sorted(recorder.read_records(args.recording), key=lambda r: r.timestamp)
+    if not records:
+        raise SystemExit("recording is empty")
+    server = start_server(args.port, args.database_url) if args.start else None
+    base_url = args.base_url or f"http://127.0.0.1:{args.port}"
+    limits = httpx.Limits(max_connections=args.max_connections)
+    try:
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+            await wait_healthy(client)
+            headers = {
+                "Authorization": f"Bearer {await login(client, args.admin_user, args.admin_password)}"
+            }
+            if args.stock is not None:
+                event_map, ticket_type_map = await create_events(
+                    client, headers, records, args.stock
+                )
+            else:
+                event_map = ticket_type_map = {}
+            tokens = await provision_users(
+                client, headers, {record.user for record in records}, args.coins
+            )
+            replayer = Replayer(
+                client, "ws" + base_url[len("http"):], tokens, args.timeout
+            )
+            for user, event_id in {
+                (record.user, record.event_id)
+                for record in records
+                if record.source == recorder.SOURCE_WS
+            }:
+                await replayer.connect(user, event_map.get(event_id, event_id))
+
+            loop = asyncio.get_running_loop()
+            first = records[0].timestamp
+            started = loop.time()
+            tasks = []
+            for record in records:
+                delay = (record.timestamp - first) / args.speed - (loop.time() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(
+                    asyncio.create_task(
+                        replayer.grab(
+                            record.source,
+                            record.user,
+                            event_map.get(record.event_id, record.event_id),
+                            ticket_type_map.get(record.ticket_type_id, record.ticket_type_id),
+                        )
+                    )
+                )
+            results = await asyncio.gather(*tasks)
+            elapsed = loop.time() - started
+            await replayer.close()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    return summarize(records, results, elapsed, args.speed)
+
+
+def summarize(
+    records: list[recorder.Record],
+    results: list[tuple[float, str]],
+    elapsed: float,
+    speed: float,
+) -> dict:
+    latencies: dict[str, list[float]] = defaultdict(list)
+    for record, (latency, _) in zip(records, results):
+        source = "websocket" if record.source == recorder.SOURCE_WS else "rest"
+        latencies[source].append(latency)
+        latencies["all"].append(latency)
+    recorded = Counter(record.outcome for record in records)
+    replayed = Counter(outcome for _, outcome in results)
+    return {
+        "grabs": len(records),
+        "recorded_seconds": records[-1].timestamp - records[0].timestamp,
+        "replay_seconds": elapsed,
+        "speed": speed,
+        "latency_ms": {
+            source: {
+                "count": len(values),
+                "p50": percentile(values, 50),
+                "p90": percentile(values, 90),
+                "p99": percentile(values, 99),
+                "max": max(values),
+            }
+            for source, values in (
+                (source, latencies[source]) for source in ("websocket", "rest", "all")
+            )
+            if values
+        },
+        "outcomes": {
+            outcome: {
+                "recorded": recorded[outcome],
+                "replayed": replayed[outcome],
+                "diff": replayed[outcome] - recorded[outcome],
+            }
+            for outcome in sorted(recorded.keys() | replayed.keys())
+        },
+        "changed": sum(
+            1 for record, (_, outcome) in zip(records, results) if outcome != record.outcome
+        ),
+    }
+
+
+def print_report(summary: dict) -> None:
+    print(
+        f"replayed {summary['grabs']} grabs in {summary['replay_seconds']:.1f}s "
+        f"(recorded over {summary['recorded_seconds']:.1f}s, speed x{summary['speed']})"
+    )
+    print(f"{'latency ms':<12}{'count':>8}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}")
+    for source, stats in summary["latency_ms"].items():
+        print(
+            f"{source:<12}{stats['count']:>8}{stats['p50']:>10.1f}{stats['p90']:>10.1f}"
+            f"{stats['p99']:>10.1f}{stats['max']:>10.1f}"
+        )
+    print(f"{'outcome':<20}{'recorded':>10}{'replayed':>10}{'diff':>8}")
+    for outcome, counts in summary["outcomes"].items():
+        print(
+            f"{outcome:<20}{counts['recorded']:>10}{counts['replayed']:>10}{counts['diff']:>+8}"
+        )
+    print(f"grabs with a different outcome: {summary['changed']}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m backend.replay", description=__doc__.split("\n")[0])
+    parser.add_argument("recording")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed factor")
+    parser.add_argument("--base-url", help="app to replay against, default the started one")
+    parser.add_argument("--start", action="store_true", help="start the app with uvicorn first")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--database-url", default="sqlite:///./replay.db")
+    parser.add_argument("--stock", type=int, help="create stand-in events with this many seats")
+    parser.add_argument("--coins", type=int, default=100000, help="energy coins per replay user")
+    parser.add_argument("--admin-user", default="admin")
+    parser.add_argument("--admin-password", default="admin")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--max-connections", type=int, default=200)
+    parser.add_argument("--json", help="also write the summary to this file")
+    args = parser.parse_args()
+    try:
+        import httpx  # noqa: F401
+        import websockets  # noqa: F401
+    except ImportError:
+        sys.exit("backend.replay needs httpx and websockets: pip install httpx websockets")
+    summary = asyncio.run(replay(args))
+    print_report(summary)
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(summary, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+import sys
+from collections import defaultdict
+from datetime import datetime
+from itertools import chain
+
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from . import models
+from .database import SessionLocal
+
+_UPSERT_INSERTS = {"sqlite": sqlite_insert, "postgresql": pg_insert}
+
+
+def bucket_start(moment: datetime) -> datetime:
+    return moment.replace(second=0, microsecond=0)
+
+
+def _increment(db: Session, model, keys: dict, sold_count: int, revenue: float) -> None:
+    insert = _UPSERT_INSERTS.get(db.get_bind().dialect.name)
+    if insert is not None:
+        stmt = insert(model).values(**keys, sold_count=sold_count, revenue=revenue)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[column.name for column in model.__table__.primary_key],
+            set_={
+                "sold_count": model.sold_count + stmt.excluded.sold_count,
+                "revenue": model.revenue + stmt.excluded.revenue,
+            },
+        )
+        db.execute(stmt)
+        return
+    updated = (
+        db.query(model)
+        .filter_by(**keys)
+        .update(
+            {
+                model.sold_count: model.sold_count + sold_count,
+                model.revenue: model.revenue + revenue,
+            },
+            synchronize_session=False,
+        )
+    )
+    if not updated:
+        db.add(model(**keys, sold_count=sold_count, revenue=revenue))
+
+
+def record_sale(
+    db: Session,
+    event_id: int,
+    ticket_type_id: int,
+    price: float,
+    created_at: datetime | None = None,
+    count: int = 1,
+) -> None:
+    """Add ``count`` sales to the counters; call before committing the order.
+
+    A negative ``count`` takes sales back out, e.g. when orders are purged.
+    """
+    created_at = created_at or datetime.utcnow()
+    revenue = (price or 0) * count
+    _increment(
+        db,
+        models.SalesCounter,
+        {"ticket_type_id": ticket_type_id, "event_id": event_id},
+        count,
+        revenue,
+    )
+    _increment(
+        db,
+        models.SalesBucket,
+        {
+            "event_id": event_id,
+            "bucket_start": bucket_start(created_at),
+            "ticket_type_id": ticket_type_id,
+        },
+        count,
+        revenue,
+    )
+
+
+def _sale_price(model):
+    # Orders from before prices were stored fall back to the current price.
+    return func.coalesce(model.price, models.TicketType.price)
+
+
+def record_order_removals(
+    db: Session, order_ids: list[int], model=models.Order
+) -> None:
+    """Take removed orders out of the counters; ``model`` may be ``ArchivedOrder``."""
+    rows = (
+        db.query(
+            model.event_id,
+            model.ticket_type_id,
+            model.created_at,
+            _sale_price(model),
+        )
+        .join(models.TicketType, model.ticket_type_id == models.TicketType.id)
+        .filter(model.id.in_(order_ids))
+    )
+    for event_id, ticket_type_id, created_at, price in rows:
+        record_sale(db, event_id, ticket_type_id, price, created_at, count=-1)
+
+
+def delete_event_counters(db: Session, event_id: int) -> None:
+    db.query(models.SalesBucket).filter(models.SalesBucket.event_id == event_id).delete(
+        synchronize_session=False
+    )
+    db.query(models.SalesCounter).filter(
+        models.SalesCounter.event_id == event_id
+    ).delete(synchronize_session=False)
+
+
+def rebuild(db: Session) -> int:
+    """Recompute all counters from live and archived orders in one streaming pass."""
+    counters: dict = defaultdict(lambda: [0, 0.0])
+    buckets: dict = defaultdict(lambda: [0, 0.0])
+    processed = 0
+    rows = chain.from_iterable(
+        db.query(
+            model.event_id,
+            model.ticket_type_id,
+            model.created_at,
+            _sale_price(model),
+        )
+        .join(models.TicketType, model.ticket_type_id == models.TicketType.id)
+        .yield_per(5000)
+        for model in (models.Order, models.ArchivedOrder)
+    )
+    for event_id, ticket_type_id, created_at, price in rows:
+        counter = counters[(ticket_type_id, event_id)]
+        counter[0] += 1
+        counter[1] += price or 0
+        bucket = buckets[(event_id, bucket_start(created_at), ticket_type_id)]
+        bucket[0] += 1
+        bucket[1] += price or 0
+        processed += 1
+
+    db.query(models.SalesBucket).delete(synchronize_session=False)
+    db.query(models.SalesCounter).delete(synchronize_session=False)
+    db.bulk_insert_mappings(
+        models.SalesCounter,
+        [
+            {
+                "ticket_type_id": ticket_type_id,
+                "event_id": event_id,
+                "sold_count": sold_count,
+                "revenue": revenue,
+            }
+            for (ticket_type_id, event_id), (sold_count, revenue) in counters.items()
+        ],
+    )
+    db.bulk_insert_mappings(
+        models.SalesBucket,
+        [
+            {
+                "event_id": event_id,
+                "bucket_start": start,
+                "ticket_type_id": ticket_type_id,
+                "sold_count": sold_count,
+                "revenue": revenue,
+            }
+            for (event_id, start, ticket_type_id), (sold_count, revenue) in buckets.items()
+        ],
+    )
+    db.commit()
+    return processed
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["rebuild"]:
+        sys.exit("usage: python -m backend.sales rebuild")
+    session = SessionLocal()
+    try:
+        print(f"rebuilt sales counters from {rebuild(session)} orders")
+    finally:
+        session.close()
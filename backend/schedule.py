@@ -0,0 +1,78 @@
+"""Per-process cache of event sale start times.
+
+Grabs sent before an event opens are refused from this cache instead of
+loading the event. Only events that exist are cached. Entries live for
+``SALE_SCHEDULE_TTL`` seconds and are dropped right away when an event is
+edited or deleted in this process, so edits made through another process are
+seen within the TTL. ``sale_start`` queries on a miss; async callers check
+``cached`` first and run it in the threadpool.
+"""
+import os
+import time
+from datetime import datetime
+
+from . import models
+from .database import SessionLocal
+
+SALE_SCHEDULE_TTL = float(os.getenv("SALE_SCHEDULE_TTL", "30"))
+
+# event id -> (sale start, expiry)
+_starts: dict[int, tuple[datetime, float]] = {}
+
+
+def server_time() -> float:
+    """Current server time in epoch milliseconds."""
+    return round(time.time() * 1000, 3)
+
+
+def cached(event_id: int) -> datetime | None:
+    """The cached sale start, or ``None`` when it must be loaded."""
+    entry = _starts.get(event_id)
+    if entry is None or entry[1] < time.monotonic():
+        return None
+    return entry[0]
+
+
+def sale_start(event_id: int) -> datetime | None:
+    """Sale start of a live event, ``None`` if it is missing; may query."""
+    start = cached(event_id)
+    if start is None:
+        db = SessionLocal()
+        try:
+            start = (
+                db.query(models.Event.sale_start_time)
+                .filter(models.Event.id == event_id, models.Event.is_deleted.is_(False))
+                .scalar()
+            )
+        finally:
+            db.close()
+        if start is not None:
+            _starts[event_id] = (start, time.monotonic() + SALE_SCHEDULE_TTL)
+    return start
+
+
+def not_started(event_id: int) -> dict | None:
+    """The grab failure for an event that has not opened yet, else ``None``."""
+    return early_failure(sale_start(event_id))
+
+
+def early_failure(start: datetime | None) -> dict | None:
+    """The grab failure for a sale starting at ``start``, if still ahead."""
+    if start is None or datetime.utcnow() >= start:
+        return None
+    return {
+        "type": "grab_result",
+        "status": "fail",
+        "reason": "抢票尚未开始",
+        "sale_start_time": start.isoformat(),
+        "server_time": server_time(),
+    }
+
+
+def forget(event_id: int) -> None:
+    _starts.pop(event_id, None)
+
+
+def time_sync(client_time) -> dict:
+    """Reply to a clock probe; clients estimate their offset from the RTT."""
+    return {"type": "time_sync", "client_time": client_time, "server_time": server_time()}
@@ -1,6 +1,8 @@
 from datetime import datetime
 from typing import List, Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, validator
+
+from .uploads import variant_url
 
 
 class Token(BaseModel):
@@ -57,12 +59,44 @@ class EventBase(BaseModel):
     seat_map_url: Optional[str] = None
     cover_image: Optional[str] = None
     limit_one_ticket_per_user: bool = False
+    allocation_mode: str = "fcfs"
+    lottery_draw_time: Optional[datetime] = None
+    is_hot: bool = False
+
+
+class EventImport(EventBase):
+    """One manifest row; image fields name zip members or existing URLs."""
+
+    ticket_types: List[TicketTypeBase] = []
+
+
+class EventImportResult(BaseModel):
+    line: int
+    status: str
+    event_id: Optional[int] = None
+    detail: Optional[str] = None
 
 
 class Event(EventBase):
     id: int
+    cover_image_thumb: Optional[str] = None
+    cover_image_web: Optional[str] = None
+    seat_map_web: Optional[str] = None
+    lottery_drawn_at: Optional[datetime] = None
     ticket_types: List[TicketType] = []
 
+    @validator("cover_image_thumb", always=True)
+    def _cover_image_thumb(cls, v, values):
+        return variant_url(values.get("cover_image"), "thumb")
+
+    @validator("cover_image_web", always=True)
+    def _cover_image_web(cls, v, values):
+        return variant_url(values.get("cover_image"), "web")
+
+    @validator("seat_map_web", always=True)
+    def _seat_map_web(cls, v, values):
+        return variant_url(values.get("seat_map_url"), "web")
+
     class Config:
         orm_mode = True
 
@@ -76,3 +110,75 @@ class Order(BaseModel):
 
     class Config:
         orm_mode = True
+
+
+class GrabResult(BaseModel):
+    order_id: int
+    ticket_type_id: int
+    energy_coins: int
+
+
+class LotteryEntry(BaseModel):
+    id: int
+    event_id: int
+    ticket_type_id: int
+    status: str
+    created_at: datetime
+
+    class Config:
+        orm_mode = True
+
+
+class LotteryDraw(BaseModel):
+    event_id: int
+    seed: str
+    entries: int
+    winning_entries: int
+
+
+class CoinLedgerEntry(BaseModel):
+    id: int
+    user_id: int
+    amount: int
+    reason: str
+    ref: Optional[str] = None
+    created_at: datetime
+
+    class Config:
+        orm_mode = True
+
+
+class Job(BaseModel):
+    id: str
+    kind: str
+    target_id: Optional[int] = None
+    status: str
+    total: int
+    processed: int
+    errors: List[str] = []
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+
+    class Config:
+        orm_mode = True
+
+
+class SalesCounter(BaseModel):
+    ticket_type_id: int
+    sold_count: int
+    revenue: float
+
+    class Config:
+        orm_mode = True
+
+
+class SalesBucket(SalesCounter):
+    bucket_start: datetime
+
+
+class EventSales(BaseModel):
+    event_id: int
+    sold_count: int
+    revenue: float
+    ticket_types: List[SalesCounter] = []
+    buckets: List[SalesBucket] = []
@@ -0,0 +1,238 @@
+import asyncio
+import json
+import os
+import time
+from typing import Dict
+
+from sqlalchemy.orm import Session
+
+from . import models, wire
+
+# Boards are reloaded from the database at least this often, so sales made
+# by other processes and edits or purges reach the watchers of this one.
+SEAT_BOARD_TTL = float(os.getenv("SEAT_BOARD_TTL", "5"))
+# Boards nobody has read for this many seconds, with no WebSocket or stream
+# attached, are dropped so ended events stop being reloaded.
+SEAT_BOARD_IDLE = float(os.getenv("SEAT_BOARD_IDLE", "60"))
+
+
+def _dumps(data: dict) -> str:
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
+
+class SeatBoard:
+    """Seat counts of one event shared by all of its watchers.
+
+    ``seq`` increases on every change so clients can order updates and spot
+    gaps. Frames are encoded once per change and reused for every connection,
+    and anonymous feeds wait on the board instead of querying the database.
+    Must only be mutated from the event loop thread.
+    """
+
+    def __init__(self, event_id: int) -> None:
+        self.event_id = event_id
+        self.seq = 0
+        # (ticket_type_id, seat_type, price) per index, ordered by id
+        self.layout: list[tuple[int, str, float]] = []
+        self.index: dict[int, int] = {}
+        self.counts: list[int] = []
+        self._frames: dict[str, str | bytes] = {}
+        self._changed = asyncio.Event()
+        self.closed = False
+        self.loaded_at = 0.0
+        # Streams and long polls attached to the board, and its last read.
+        self.readers = 0
+        self.used_at = time.monotonic()
+
+    def apply(self, rows: list[tuple[int, str, float, int]]) -> tuple[bool, list[int]]:
+        """Load ``(id, seat_type, price, available_qty)`` rows.
+
+        Returns whether the ticket type layout changed and the indexes whose
+        counts changed.
+        """
+        self.loaded_at = time.monotonic()
+        layout = [(row[0], row[1], row[2]) for row in rows]
+        counts = [row[3] for row in rows]
+        if layout != self.layout:
+            self.layout = layout
+            self.index = {entry[0]: i for i, entry in enumerate(layout)}
+            self.counts = counts
+            self._bump()
+            return True, list(range(len(counts)))
+        changed = [
+            i for i, (old, new) in enumerate(zip(self.counts, counts)) if old != new
+        ]
+        if changed:
+            self.counts = counts
+            self._bump()
+        return False, changed
+
+    def _bump(self) -> None:
+        self.seq += 1
+        self._frames.clear()
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    @property
+    def fresh(self) -> bool:
+        """Whether the counts were loaded within ``SEAT_BOARD_TTL``."""
+        return time.monotonic() - self.loaded_at < SEAT_BOARD_TTL
+
+    def touch(self) -> None:
+        self.used_at = time.monotonic()
+
+    def idle(self) -> bool:
+        """Whether no reader is attached and none came for ``SEAT_BOARD_IDLE``."""
+        return self.readers == 0 and time.monotonic() - self.used_at > SEAT_BOARD_IDLE
+
+    def close(self) -> None:
+        """Release waiters once the event is gone."""
+        self.closed = True
+        self._changed.set()
+
+    async def wait_for_change(self, since: int, timeout: float) -> bool:
+        if self.seq != since or self.closed:
+            return True
+        changed = self._changed
+        self.readers += 1
+        try:
+            await asyncio.wait_for(changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.readers -= 1
+            self.touch()
+        return True
+
+    def available(self, ticket_type_id: int) -> int | None:
+        i = self.index.get(ticket_type_id)
+        return None if i is None else self.counts[i]
+
+    def sold_out(self, ticket_type_id: int) -> bool:
+        return self.available(ticket_type_id) == 0
+
+    def tickets(self) -> list[dict]:
+        return [
+            {
+                "ticket_type_id": ticket_type_id,
+                "seat_type": seat_type,
+                "available_qty": qty,
+            }
+            for (ticket_type_id, seat_type, _), qty in zip(self.layout, self.counts)
+        ]
+
+    def json_frame(self) -> str:
+        if "json" not in self._frames:
+            self._frames["json"] = _dumps(
+                {"type": "seat_counts", "seq": self.seq, "tickets": self.tickets()}
+            )
+        return self._frames["json"]
+
+    def sse_frame(self) -> str:
+        if "sse" not in self._frames:
+            self._frames["sse"] = (
+                f"id: {self.seq}\nevent: seat_counts\ndata: {self.json_frame()}\n\n"
+            )
+        return self._frames["sse"]
+
+    def meta_frame(self) -> str:
+        if "meta" not in self._frames:
+            self._frames["meta"] = _dumps(
+                {
+                    "type": "seat_meta",
+                    "seq": self.seq,
+                    "ticket_types": [
+                        {
+                            "index": i,
+                            "ticket_type_id": ticket_type_id,
+                            "seat_type": seat_type,
+                            "price": price,
+                        }
+                        for i, (ticket_type_id, seat_type, price) in enumerate(self.layout)
+                    ],
+                }
+            )
+        return self._frames["meta"]
+
+    def failure_frame(self, reason: str, ticket_type_id: int) -> str:
+        """Grab failure listing the other ticket types that are left."""
+        key = f"fail:{reason}:{ticket_type_id}"
+        if key not in self._frames:
+            self._frames[key] = _dumps(
+                {
+                    "type": "grab_result",
+                    "status": "fail",
+                    "reason": reason,
+                    "alternatives": [
+                        ticket
+                        for ticket in self.tickets()
+                        if ticket["available_qty"] > 0
+                        and ticket["ticket_type_id"] != ticket_type_id
+                    ],
+                }
+            )
+        return self._frames[key]
+
+    def snapshot_frame(self) -> bytes:
+        if "snapshot" not in self._frames:
+            self._frames["snapshot"] = wire.encode_seats(
+                wire.FRAME_SNAPSHOT, self.seq, enumerate(self.counts)
+            )
+        return self._frames["snapshot"]
+
+    def delta_frame(self, changed: list[int]) -> bytes:
+        return wire.encode_seats(
+            wire.FRAME_DELTA, self.seq, ((i, self.counts[i]) for i in changed)
+        )
+
+
+boards: Dict[int, SeatBoard] = {}
+
+
+def load_rows(db: Session, event_id: int) -> list[tuple[int, str, float, int]]:
+    return [
+        tuple(row)
+        for row in db.query(
+            models.TicketType.id,
+            models.TicketType.seat_type,
+            models.TicketType.price,
+            models.TicketType.available_qty,
+        )
+        .filter(models.TicketType.event_id == event_id)
+        .order_by(models.TicketType.id)
+    ]
+
+
+def load_live_rows(
+    db: Session, event_ids: list[int]
+) -> dict[int, list[tuple[int, str, float, int]]]:
+    """Seat rows of the live events among ``event_ids``, in two queries."""
+    rows: dict[int, list] = {
+        event_id: []
+        for (event_id,) in db.query(models.Event.id).filter(
+            models.Event.id.in_(event_ids), models.Event.is_deleted.is_(False)
+        )
+    }
+    for event_id, *row in (
+        db.query(
+            models.TicketType.event_id,
+            models.TicketType.id,
+            models.TicketType.seat_type,
+            models.TicketType.price,
+            models.TicketType.available_qty,
+        )
+        .filter(models.TicketType.event_id.in_(list(rows)))
+        .order_by(models.TicketType.id)
+    ):
+        rows[event_id].append(tuple(row))
+    return rows
+
+
+def publish(
+    event_id: int, rows: list[tuple[int, str, float, int]]
+) -> tuple[SeatBoard, bool, list[int]]:
+    board = boards.get(event_id)
+    if board is None:
+        board = boards[event_id] = SeatBoard(event_id)
+    layout_changed, changed = board.apply(rows)
+    return board, layout_changed, changed
@@ -0,0 +1,319 @@
+"""Soak test: hold many idle event WebSockets open against one app node.
+
+    python -m backend.soak --start --connections 20000 --step 2000 --hold 120
+
+Connections are opened in steps of ``--step`` from ``--processes`` client
+processes. After each step the tool waits ``--settle`` seconds and samples
+the server's resident memory and the ``websocket_connections`` count from
+``/health``. Ramping stops at ``--connections`` or at the first step with
+failed handshakes. The open connections are then held for ``--hold``
+seconds, long enough for several keepalive pings, and the report gives
+memory per connection and how many connections stayed up.
+
+Memory is only sampled when the app was started here or ``--server-pid`` is
+given (Linux ``/proc``). Raise ``ulimit -n`` for both sides first. One source
+address reaches about 28k ephemeral ports per server port, so spread larger
+runs with ``--source-ips 127.0.0.2,127.0.0.3``. Needs ``httpx`` and
+``websockets``.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import resource
+import shlex
+import sys
+import time
+from datetime import datetime, timedelta
+
+from .replay import login, start_server, wait_healthy
+
+PASSWORD = "soak"
+
+
+def raise_fd_limit() -> int:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def server_rss(pid: int | None) -> int | None:
+    """Resident memory of ``pid`` in bytes, if it can be read."""
+    if pid is None:
+        return None
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+async def _client(pipe, urls: list[str], source_ip: str | None, compression: bool) -> None:
+    import websockets
+
+    loop = asyncio.get_running_loop()
+    connections: set = set()
+    opened = 0
+
+    async def hold(url: str) -> bool:
+        try:
+            connection = await websockets.connect(
+                url,
+                compression="deflate" if compression else None,
+                open_timeout=30,
+                local_addr=(source_ip, 0) if source_ip else None,
+            )
+        except Exception:
+            return False
+        connections.add(connection)
+        asyncio.create_task(_drain(connection, connections))
+        return True
+
+    while True:
+        command, count = await loop.run_in_executor(None, pipe.recv)
+        if command == "open":
+            results = await asyncio.gather(
+                *(hold(urls[(opened + i) % len(urls)]) for i in range(count))
+            )
+            opened += count
+            pipe.send((sum(results), count - sum(results)))
+        elif command == "alive":
+            pipe.send(len(connections))
+        else:
+            for connection in list(connections):
+                await connection.close()
+            pipe.send(0)
+            return
+
+
+async def _drain(connection, connections: set) -> None:
+    # Reading keeps the receive queue empty; pings are answered by the library.
+    try:
+        async for _ in connection:
+            pass
+    except Exception:
+        pass
+    finally:
+        connections.discard(connection)
+
+
+def _client_main(pipe, urls: list[str], source_ip: str | None, compression: bool) -> None:
+    raise_fd_limit()
+    asyncio.run(_client(pipe, urls, source_ip, compression))
+
+
+class Clients:
+    """Client processes driven over pipes; connections go round-robin."""
+
+    def __init__(self, count: int, urls: list[str], source_ips: list[str], compression: bool) -> None:
+        context = multiprocessing.get_context("spawn")
+        self.pipes = []
+        self.processes = []
+        for i in range(count):
+            parent, child = context.Pipe()
+            source_ip = source_ips[i % len(source_ips)] if source_ips else None
+            process = context.Process(
+                target=_client_main, args=(child, urls, source_ip, compression), daemon=True
+            )
+            process.start()
+            self.pipes.append(parent)
+            self.processes.append(process)
+
+    def _ask(self, messages: list) -> list:
+        for pipe, message in zip(self.pipes, messages):
+            pipe.send(message)
+        return [pipe.recv() for pipe in self.pipes]
+
+    def open(self, count: int) -> tuple[int, int]:
+        share, extra = divmod(count, len(self.pipes))
+        replies = self._ask(
+            [("open", share + (1 if i < extra else 0)) for i in range(len(self.pipes))]
+        )
+        return sum(r[0] for r in replies), sum(r[1] for r in replies)
+
+    def alive(self) -> int:
+        return sum(self._ask([("alive", 0)] * len(self.pipes)))
+
+    def close(self) -> None:
+        self._ask([("close", 0)] * len(self.pipes))
+        for process in self.processes:
+            process.join(timeout=10)
+
+
+async def prepare(client, args: argparse.Namespace) -> tuple[str, list[int]]:
+    """Return a watcher token and the events to watch, creating one if needed."""
+    response = await client.post(
+        "/auth/register",
+        json={"username": args.username, "password": PASSWORD, "energy_coins": 0},
+    )
+    if response.status_code not in (200, 400):
+        response.raise_for_status()
+    token = await login(client, args.username, PASSWORD)
+    if args.event_id:
+        return token, args.event_id
+    admin_token = await login(client, args.admin_user, args.admin_password)
+    sale_start = datetime.utcnow() + timedelta(days=1)
+    response = await client.post(
+        "/events",
+        headers={"Authorization": f"Bearer {admin_token}"},
+        data={
+            "title": "soak",
+            "organizer": "soak",
+            "location": "soak",
+            "sale_start_time": sale_start.isoformat(),
+            "start_time": (sale_start + timedelta(days=1)).isoformat(),
+            "ticket_types": json.dumps(
+                [{"seat_type": "A", "price": 1, "available_qty": 100}]
+            ),
+        },
+    )
+    response.raise_for_status()
+    return token, [response.json()["id"]]
+
+
+async def health_connections(client) -> int | None:
+    try:
+        return (await client.get("/health")).json().get("websocket_connections")
+    except Exception:
+        return None
+
+
+async def soak(args: argparse.Namespace) -> dict:
+    import httpx
+
+    raise_fd_limit()
+    server = (
+        start_server(args.port, args.database_url, *shlex.split(args.server_args))
+        if args.start
+        else None
+    )
+    pid = server.pid if server is not None else args.server_pid
+    base_url = args.base_url or f"http://127.0.0.1:{args.port}"
+    steps = []
+    clients = None
+    try:
+        async with httpx.AsyncClient(base_url=base_url, timeout=30) as client:
+            await wait_healthy(client)
+            token, event_ids = await prepare(client, args)
+            ws_base = "ws" + base_url[len("http"):]
+            urls = [f"{ws_base}/ws/events/{event_id}?token={token}" for event_id in event_ids]
+            await asyncio.sleep(args.settle)
+            baseline = server_rss(pid)
+            clients = Clients(args.processes, urls, args.source_ips, not args.no_compression)
+            target = 0
+            while target < args.connections:
+                step = min(args.step, args.connections - target)
+                started = time.perf_counter()
+                opened, failed = await asyncio.to_thread(clients.open, step)
+                target += step
+                seconds = time.perf_counter() - started
+                await asyncio.sleep(args.settle)
+                alive = await asyncio.to_thread(clients.alive)
+                steps.append(
+                    {
+                        "requested": target,
+                        "opened": opened,
+                        "failed": failed,
+                        "alive": alive,
+                        "server_connections": await health_connections(client),
+                        "open_seconds": seconds,
+                        "server_rss": server_rss(pid),
+                    }
+                )
+                print_step(steps[-1], baseline)
+                if failed:
+                    break
+            held_from = await asyncio.to_thread(clients.alive)
+            await asyncio.sleep(args.hold)
+            held = await asyncio.to_thread(clients.alive)
+            final_rss = server_rss(pid)
+            server_connections = await health_connections(client)
+    finally:
+        if clients is not None:
+            await asyncio.to_thread(clients.close)
+        if server is not None:
+            server.terminate()
+            server.wait()
+    return {
+        "steps": steps,
+        "baseline_rss": baseline,
+        "final_rss": final_rss,
+        "hold_seconds": args.hold,
+        "held_from": held_from,
+        "held": held,
+        "server_connections": server_connections,
+        "bytes_per_connection": (
+            (final_rss - baseline) / held if held and final_rss and baseline else None
+        ),
+    }
+
+
+def _mb(value: int | None) -> str:
+    return "-" if value is None else f"{value / 2**20:.1f}"
+
+
+def print_step(step: dict, baseline: int | None) -> None:
+    per_connection = "-"
+    if step["server_rss"] and baseline and step["alive"]:
+        per_connection = f"{(step['server_rss'] - baseline) / step['alive'] / 1024:.1f}"
+    print(
+        f"{step['requested']:>9}{step['opened']:>9}{step['failed']:>8}{step['alive']:>9}"
+        f"{str(step['server_connections']):>9}{step['open_seconds']:>9.1f}"
+        f"{_mb(step['server_rss']):>10}{per_connection:>10}",
+        flush=True,
+    )
+
+
+def print_report(summary: dict) -> None:
+    print(
+        f"held {summary['held']} of {summary['held_from']} connections for "
+        f"{summary['hold_seconds']:.0f}s (server reports {summary['server_connections']})"
+    )
+    print(
+        f"server memory {_mb(summary['baseline_rss'])} MB idle, "
+        f"{_mb(summary['final_rss'])} MB with connections"
+    )
+    if summary["bytes_per_connection"] is not None:
+        print(f"memory per connection: {summary['bytes_per_connection'] / 1024:.1f} KB")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m backend.soak", description=__doc__.split("\n")[0])
+    parser.add_argument("--connections", type=int, default=10000)
+    parser.add_argument("--step", type=int, default=1000)
+    parser.add_argument("--settle", type=float, default=3, help="seconds to wait after each step")
+    parser.add_argument("--hold", type=float, default=60, help="seconds to hold all connections")
+    parser.add_argument("--processes", type=int, default=4, help="client processes")
+    parser.add_argument("--source-ips", type=lambda v: v.split(","), default=[])
+    parser.add_argument("--no-compression", action="store_true", help="do not offer permessage-deflate")
+    parser.add_argument("--event-id", type=int, action="append", help="event to watch, repeatable")
+    parser.add_argument("--username", default="soak", help="watcher account, registered if missing")
+    parser.add_argument("--base-url", help="app to connect to, default the started one")
+    parser.add_argument("--start", action="store_true", help="start the app with uvicorn first")
+    parser.add_argument("--server-args", default="", help="extra uvicorn options for --start")
+    parser.add_argument("--server-pid", type=int, help="pid of the app to sample memory from")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--database-url", default="sqlite:///./soak.db")
+    parser.add_argument("--admin-user", default="admin")
+    parser.add_argument("--admin-password", default="admin")
+    parser.add_argument("--json", help="also write the summary to this file")
+    args = parser.parse_args()
+    try:
+        import httpx  # noqa: F401
+        import websockets  # noqa: F401
+    except ImportError:
+        sys.exit("backend.soak needs httpx and websockets: pip install httpx websockets")
+    print(f"{'requested':>9}{'opened':>9}{'failed':>8}{'alive':>9}{'server':>9}{'open s':>9}{'rss MB':>10}{'KB/conn':>10}")
+    summary = asyncio.run(soak(args))
+    print_report(summary)
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(summary, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
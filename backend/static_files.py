@@ -0,0 +1,205 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import sys
+import tempfile
+
+import brotli
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse
+from starlette.types import Scope
+
+COMPRESSIBLE_SUFFIXES = {
+    ".css",
+    ".html",
+    ".js",
+    ".json",
+    ".map",
+    ".mjs",
+    ".svg",
+    ".txt",
+    ".xml",
+}
+MIN_COMPRESS_SIZE = 1024
+
+# Preferred encoding first; each maps to the suffix of the precompressed copy.
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+# Content-addressed uploads (<sha256>.png, <sha256>_thumb.webp) never change
+# under the same name; neither does Vite's build output under assets/.
+_UPLOAD_NAME = re.compile(r"^[0-9a-f]{64}(?:_[a-z]+)?\.[A-Za-z0-9]+$")
+BUILD_ASSETS_DIR = "assets"
+
+
+def _is_compressible(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() in COMPRESSIBLE_SUFFIXES
+
+
+def _compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=11)
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def precompress(directory: str) -> int:
+    """Write ``.br``/``.gz`` siblings for compressible files that lack fresh ones.
+
+    Returns the number of variants written.
+    """
+    written = 0
+    for root, _dirs, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            if not _is_compressible(path):
+                continue
+            source_stat = os.stat(path)
+            if source_stat.st_size < MIN_COMPRESS_SIZE:
+                continue
+            data = None
+            for encoding, suffix in ENCODINGS:
+                target = path + suffix
+                try:
+                    if os.stat(target).st_mtime >= source_stat.st_mtime:
+                        continue
+                except FileNotFoundError:
+                    pass
+                if data is None:
+                    with open(path, "rb") as source:
+                        data = source.read()
+                compressed = _compress(data, encoding)
+                if len(compressed) >= len(data):
+                    continue
+                # Every worker precompresses at startup; unique temp names keep
+                # them from truncating each other's files.
+                fd, tmp_path = tempfile.mkstemp(dir=root, suffix=".part")
+                try:
+                    with os.fdopen(fd, "wb") as buffer:
+                        buffer.write(compressed)
+                    os.chmod(tmp_path, source_stat.st_mode & 0o777)
+                    os.replace(tmp_path, target)
+                except BaseException:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    raise
+                written += 1
+    return written
+
+
+def _accepted_encodings(header: str) -> set[str]:
+    accepted = set()
+    for part in header.split(","):
+        token, _, params = part.strip().partition(";")
+        token = token.strip().lower()
+        if not token:
+            continue
+        quality = params.strip()
+        if quality.startswith("q="):
+            try:
+                if float(quality[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(token)
+    return accepted
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """``StaticFiles`` that serves precompressed variants with cache headers.
+
+    Strong ETags are content hashes, computed once per file version in the
+    lookup thread so the event loop never reads file contents. Responses are
+    plain ``FileResponse`` objects, which use the ASGI ``pathsend`` extension
+    for zero-copy transfer on servers that support it.
+    """
+
+    def __init__(self, *args, immutable: bool = False, **kwargs) -> None:
+        """``immutable`` marks a directory holding only hashed build output."""
+        super().__init__(*args, **kwargs)
+        self.immutable = immutable
+        self._etags: dict[str, tuple[int, int, str]] = {}
+
+    def _is_immutable(self, full_path: str) -> bool:
+        if self.immutable or _UPLOAD_NAME.match(os.path.basename(full_path)):
+            return True
+        relative = os.path.relpath(full_path, self.directory)
+        return relative.split(os.sep, 1)[0] == BUILD_ASSETS_DIR
+
+    def _content_etag(self, path: str, stat_result: os.stat_result) -> str:
+        cached = self._etags.get(path)
+        if cached and cached[0] == stat_result.st_mtime_ns and cached[1] == stat_result.st_size:
+            return cached[2]
+        digest = hashlib.sha1()
+        with open(path, "rb") as source:
+            for chunk in iter(lambda: source.read(1024 * 1024), b""):
+                digest.update(chunk)
+        etag = f'"{digest.hexdigest()}"'
+        self._etags[path] = (stat_result.st_mtime_ns, stat_result.st_size, etag)
+        return etag
+
+    def lookup_path(self, path: str) -> tuple[str, os.stat_result | None]:
+        full_path, stat_result = super().lookup_path(path)
+        if stat_result is not None and os.path.isfile(full_path):
+            self._content_etag(full_path, stat_result)
+        return full_path, stat_result
+
+    def file_response(
+        self,
+        full_path: str,
+        stat_result: os.stat_result,
+        scope: Scope,
+        status_code: int = 200,
+    ) -> Response:
+        request_headers = Headers(scope=scope)
+        full_path = os.fspath(full_path)
+        served_path, served_stat, encoding = full_path, stat_result, None
+        compressible = _is_compressible(full_path)
+        if compressible:
+            accepted = _accepted_encodings(request_headers.get("accept-encoding", ""))
+            for candidate, suffix in ENCODINGS:
+                if candidate not in accepted:
+                    continue
+                try:
+                    candidate_stat = os.stat(full_path + suffix)
+                except OSError:
+                    continue
+                if candidate_stat.st_mtime >= stat_result.st_mtime:
+                    served_path, served_stat, encoding = (
+                        full_path + suffix,
+                        candidate_stat,
+                        candidate,
+                    )
+                    break
+
+        media_type = mimetypes.guess_type(full_path)[0] or "text/plain"
+        response = FileResponse(
+            served_path,
+            status_code=status_code,
+            stat_result=served_stat,
+            media_type=media_type,
+        )
+        etag = self._content_etag(full_path, stat_result)
+        if encoding:
+            etag = f'{etag[:-1]}-{encoding}"'
+            response.headers["content-encoding"] = encoding
+        response.headers["etag"] = etag
+        if compressible:
+            response.headers["vary"] = "Accept-Encoding"
+        if self._is_immutable(full_path):
+            response.headers["cache-control"] = IMMUTABLE_CACHE_CONTROL
+        else:
+            response.headers["cache-control"] = REVALIDATE_CACHE_CONTROL
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+if __name__ == "__main__":
+    for target_dir in sys.argv[1:] or ["static"]:
+        print(f"{target_dir}: {precompress(target_dir)} variants written")
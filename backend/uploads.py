@@ -0,0 +1,169 @@
+import hashlib
+import multiprocessing
+import os
+import re
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import BinaryIO
+
+from fastapi import UploadFile
+from fastapi.concurrency import run_in_threadpool
+
+STATIC_ROOT = "static"
+VARIANTS_DIR = os.path.join(STATIC_ROOT, "variants")
+CHUNK_SIZE = 1024 * 1024
+
+# Variant name -> bounding box; variants keep the aspect ratio of the source.
+IMAGE_VARIANTS = {
+    "thumb": (320, 320),
+    "web": (1280, 1280),
+}
+VARIANT_FORMAT = "webp"
+VARIANT_QUALITY = 80
+
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+# A variant that does not exist yet is looked up again after this many seconds.
+VARIANT_RECHECK_SECONDS = 10.0
+
+_executor: ProcessPoolExecutor | None = None
+# (stored name, variant) -> (url or None, when to look again)
+_variant_urls: dict[tuple[str, str], tuple[str | None, float]] = {}
+
+
+def _safe_extension(filename: str | None) -> str:
+    ext = os.path.splitext(filename or "")[1].lower()
+    if re.fullmatch(r"\.[a-z0-9]{1,8}", ext):
+        return ext
+    return ""
+
+
+def store_stream(source: BinaryIO, filename: str | None) -> str:
+    """Copy ``source`` into the static root under its content hash.
+
+    Blocking; call it from a worker thread. Returns the stored file name.
+    """
+    os.makedirs(STATIC_ROOT, exist_ok=True)
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=STATIC_ROOT, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as buffer:
+            while True:
+                chunk = source.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                buffer.write(chunk)
+        stored_name = f"{digest.hexdigest()}{_safe_extension(filename)}"
+        target = os.path.join(STATIC_ROOT, stored_name)
+        if os.path.exists(target):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, target)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return stored_name
+
+
+def _variant_path(stored_name: str, variant: str) -> str:
+    stem = os.path.splitext(stored_name)[0]
+    return os.path.join(VARIANTS_DIR, f"{stem}_{variant}.{VARIANT_FORMAT}")
+
+
+def _build_variants(stored_name: str) -> None:
+    from PIL import Image, ImageOps
+
+    source_path = os.path.join(STATIC_ROOT, stored_name)
+    targets = {
+        variant: _variant_path(stored_name, variant)
+        for variant in IMAGE_VARIANTS
+    }
+    if all(os.path.exists(path) for path in targets.values()):
+        return
+    os.makedirs(VARIANTS_DIR, exist_ok=True)
+    try:
+        with Image.open(source_path) as original:
+            image = ImageOps.exif_transpose(original)
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+            for variant, size in IMAGE_VARIANTS.items():
+                if os.path.exists(targets[variant]):
+                    continue
+                resized = image.copy()
+                resized.thumbnail(size, Image.LANCZOS)
+                fd, tmp_path = tempfile.mkstemp(dir=VARIANTS_DIR, suffix=".part")
+                os.close(fd)
+                try:
+                    resized.save(tmp_path, VARIANT_FORMAT, quality=VARIANT_QUALITY)
+                    os.replace(tmp_path, targets[variant])
+                except BaseException:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    raise
+    except (OSError, Image.DecompressionBombError):
+        # Not an image Pillow understands; the original is still served.
+        return
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # Forking a threaded server can deadlock the children.
+        _executor = ProcessPoolExecutor(
+            max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _executor
+
+
+def schedule_variants(stored_name: str) -> None:
+    _get_executor().submit(_build_variants, stored_name)
+
+
+def shutdown_workers() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def save_upload(upload: UploadFile) -> str:
+    """Store an uploaded image off the event loop and return its URL."""
+    stored_name = await run_in_threadpool(store_stream, upload.file, upload.filename)
+    schedule_variants(stored_name)
+    return f"/static/{stored_name}"
+
+
+def variant_url(url: str | None, variant: str) -> str | None:
+    """URL of a generated variant, or ``None`` while it does not exist.
+
+    Stored names are content hashes, so a variant that exists is remembered
+    and missing ones are only looked up again every few seconds.
+    """
+    if not url or not url.startswith("/static/"):
+        return None
+    key = (url[len("/static/"):], variant)
+    cached = _variant_urls.get(key)
+    if cached is None or (cached[0] is None and cached[1] < time.monotonic()):
+        path = _variant_path(key[0], variant)
+        found = "/" + path.replace(os.sep, "/") if os.path.exists(path) else None
+        cached = (found, time.monotonic() + VARIANT_RECHECK_SECONDS)
+        _variant_urls[key] = cached
+    return cached[0]
+
+
+def remove_upload(url: str | None) -> None:
+    if not url or not url.startswith("/static/"):
+        return
+    stored_name = url[len("/static/"):]
+    for variant in IMAGE_VARIANTS:
+        _variant_urls.pop((stored_name, variant), None)
+    paths = [os.path.join(STATIC_ROOT, stored_name)]
+    paths.extend(_variant_path(stored_name, variant) for variant in IMAGE_VARIANTS)
+    for path in paths:
+        if os.path.isfile(path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
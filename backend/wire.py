@@ -0,0 +1,40 @@
+"""Compact binary WebSocket protocol, negotiated via ``Sec-WebSocket-Protocol``.
+
+Clients that request ``SUBPROTOCOL`` first receive a ``seat_meta`` JSON text
+frame listing every ticket type with its index. Seat counts then arrive as
+binary frames: a ``<BIH`` header (frame kind, sequence number, entry count)
+followed by ``<HI`` entries (ticket type index, available quantity). A
+``FRAME_SNAPSHOT`` carries every ticket type, a ``FRAME_DELTA`` only the ones
+that changed since the previous sequence number. A client that notices a gap
+in sequence numbers sends ``OP_SYNC`` to get a fresh snapshot.
+
+Client requests are ``<BI`` frames (opcode, ticket type id). JSON text
+messages keep working on binary connections, and grab results are always JSON.
+"""
+import struct
+from typing import Iterable
+
+SUBPROTOCOL = "grabticket.bin.v1"
+
+FRAME_SNAPSHOT = 1
+FRAME_DELTA = 2
+
+OP_GRAB = 1
+OP_SYNC = 2
+
+_HEADER = struct.Struct("<BIH")
+_ENTRY = struct.Struct("<HI")
+_REQUEST = struct.Struct("<BI")
+
+
+def encode_seats(kind: int, seq: int, entries: Iterable[tuple[int, int]]) -> bytes:
+    entries = list(entries)
+    parts = [_HEADER.pack(kind, seq & 0xFFFFFFFF, len(entries))]
+    parts.extend(_ENTRY.pack(index, max(qty, 0)) for index, qty in entries)
+    return b"".join(parts)
+
+
+def decode_request(data: bytes) -> tuple[int, int] | None:
+    if len(data) != _REQUEST.size:
+        return None
+    return _REQUEST.unpack(data)